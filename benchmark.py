@@ -0,0 +1,292 @@
+"""Data-scale benchmark for the report and history handlers.
+
+Seeds a Mongo stand-in with N purchases and runs show_history, duecheck_cmd,
+daily_due_payment_check and the expiry reminder pass against a fake Bot that only
+records API calls. Reports wall time, DB round trips, Telegram calls and peak
+Python memory per handler.
+
+    pip install mongomock-motor
+    python benchmark.py                         # 1k/10k/100k on mongomock
+    python benchmark.py --sizes 1000,10000 --save baseline.json
+    python benchmark.py --baseline baseline.json  # show change vs a saved run
+    python benchmark.py --mongo-uri mongodb://localhost:27017  # local mongod
+
+mongomock returns a whole cursor in its first batch, so streamed reports show
+a higher memory peak there than against a real mongod.
+"""
+import os
+
+os.environ.setdefault("MONGO_URI", "mongodb://127.0.0.1:27017")
+
+import argparse
+import asyncio
+import itertools
+import json
+import random
+import tracemalloc
+from datetime import datetime, timedelta
+from time import perf_counter
+
+import bot
+
+BENCH_DB = "apkbench"
+OWNER_COUNT = 10  # super admin + 9 admins
+_message_ids = itertools.count(1)
+
+# ---- Fake Telegram objects ----
+class FakeMessage:
+    def __init__(self, fake_bot, chat_id: int):
+        self.bot = fake_bot
+        self.chat_id = chat_id
+        self.message_id = next(_message_ids)
+
+    async def reply_text(self, text, reply_markup=None, **kwargs):
+        return await self.bot.send_message(chat_id=self.chat_id, text=text, reply_markup=reply_markup)
+
+class FakeBot:
+    """Records every Bot API call instead of sending it"""
+
+    def __init__(self):
+        self.calls = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.calls.append("send_message")
+        return FakeMessage(self, chat_id)
+
+    async def edit_message_text(self, chat_id=None, message_id=None, text=None, **kwargs):
+        self.calls.append("edit_message_text")
+        return FakeMessage(self, chat_id)
+
+class FakeUser:
+    def __init__(self, user_id: int):
+        self.id = user_id
+        self.username = f"user{user_id}"
+
+class FakeChat:
+    def __init__(self, chat_id: int):
+        self.id = chat_id
+
+class FakeJob:
+    removed = False
+
+    def schedule_removal(self):
+        self.removed = True
+
+class FakeJobQueue:
+    """Accepts the expiry scheduler's timer without ever running it"""
+
+    def run_once(self, callback, when, name=None):
+        return FakeJob()
+
+class FakeApp:
+    def __init__(self):
+        self.job_queue = FakeJobQueue()
+
+class FakeUpdate:
+    def __init__(self, fake_bot, user_id: int):
+        self.effective_user = FakeUser(user_id)
+        self.effective_chat = FakeChat(user_id)
+        self.message = FakeMessage(fake_bot, user_id)
+        self.callback_query = None
+
+class FakeContext:
+    def __init__(self, fake_bot, args=None):
+        self.bot = fake_bot
+        self.args = args or []
+        self.user_data = {}
+
+# ---- Seeding ----
+def owner_ids() -> list[int]:
+    return [bot.SUPER_ADMIN_ID] + [1000 + i for i in range(1, OWNER_COUNT)]
+
+def heavy_client_records(size: int) -> int:
+    return max(size // 100, 20)
+
+def make_purchases(size: int, rng: random.Random):
+    """Yield purchase documents shaped like confirm_cb's, with payments"""
+    owners = owner_ids()
+    now = datetime.now()
+    today = datetime.combine(now.date(), datetime.min.time())
+    clients = max(size // 5, 1)
+    heavy = heavy_client_records(size)
+    for i in range(size):
+        name = "HeavyClient" if i < heavy else f"Client{rng.randrange(clients)}"
+        purchase_date = today - timedelta(days=rng.randrange(365))
+        expiry_date = today + timedelta(hours=12) if rng.random() < 0.02 else purchase_date + timedelta(days=30)
+        total = float(rng.choice([100, 150, 200, 300, 500]))
+        payments = []
+        paid = 0.0
+        for _ in range(rng.randrange(4)):
+            amount = float(rng.randrange(10, 60))
+            if paid + amount >= total:
+                break
+            paid += amount
+            payments.append({"amount": amount, "date": bot.fmt(purchase_date + timedelta(days=len(payments) + 1)), "type": "partial"})
+        due = 0.0 if rng.random() < 0.6 else total - paid
+        if due == 0 and payments:
+            payments[-1]["type"] = "final"
+        owner_id = owners[i % len(owners)]
+        yield {
+            "client_name": name,
+            "client_key": bot.normalize_client_name(name),
+            "apk_name": f"APK{rng.randrange(50)}",
+            "purchase_date": purchase_date,
+            "expiry_date": expiry_date,
+            "total_price": total,
+            "due_amount": due,
+            "status": "deleted" if rng.random() < 0.05 else "active",
+            "payments": payments,
+            "added_by": owner_id,
+            "owner_username": "",
+            "owner_id": owner_id,
+            "created_at": purchase_date,
+        }
+
+async def seed(size: int, seed_value: int):
+    db = bot.store.db
+    await db.purchases.delete_many({})
+    await db.admins.delete_many({})
+    await db.admins.insert_many([
+        {"user_id": owner_id, "username": f"user{owner_id}", "status": "active"} for owner_id in owner_ids()
+    ])
+    rng = random.Random(seed_value)
+    batch = []
+    for doc in make_purchases(size, rng):
+        batch.append(doc)
+        if len(batch) == 5000:
+            await db.purchases.insert_many(batch)
+            batch = []
+    if batch:
+        await db.purchases.insert_many(batch)
+    await bot.ensure_indexes()
+    await bot.rebuild_due_ledger()
+    bot.admin_registry.invalidate()
+    await bot.admin_registry.refresh()
+
+# ---- Scenarios ----
+def scenarios(size: int) -> dict:
+    last_page = (heavy_client_records(size) - 1) // bot.HISTORY_PAGE_SIZE
+
+    async def history_first(fake_bot):
+        await bot.show_history("HeavyClient", FakeUpdate(fake_bot, bot.SUPER_ADMIN_ID), FakeContext(fake_bot), page=0)
+
+    async def history_last(fake_bot):
+        await bot.show_history("HeavyClient", FakeUpdate(fake_bot, bot.SUPER_ADMIN_ID), FakeContext(fake_bot), page=last_page)
+
+    async def duecheck_all(fake_bot):
+        await bot.duecheck_cmd(FakeUpdate(fake_bot, bot.SUPER_ADMIN_ID), FakeContext(fake_bot))
+
+    async def duecheck_client(fake_bot):
+        await bot.duecheck_cmd(FakeUpdate(fake_bot, bot.SUPER_ADMIN_ID), FakeContext(fake_bot, ["HeavyClient"]))
+
+    async def daily_dues(fake_bot):
+        await bot.daily_due_payment_check(FakeContext(fake_bot))
+
+    async def expiry_reminders(fake_bot):
+        # Replay everything due from yesterday up to the end of today
+        today = datetime.combine(datetime.now().date(), datetime.min.time())
+        scheduler = bot.expiry_scheduler
+        scheduler.attach(FakeApp())
+        scheduler.watermark = today - timedelta(days=1)
+        await scheduler.load()
+        await scheduler.fire_due(fake_bot, now=today + timedelta(days=1) - timedelta(seconds=1))
+
+    return {
+        "show_history (first page)": history_first,
+        "show_history (last page)": history_last,
+        "duecheck_cmd (all)": duecheck_all,
+        "duecheck_cmd (one client)": duecheck_client,
+        "daily_due_payment_check": daily_dues,
+        "expiry reminders": expiry_reminders,
+    }
+
+async def measure(run) -> dict:
+    """Time one run, then repeat it under tracemalloc for the memory peak"""
+    fake_bot = FakeBot()
+    ops = bot.store.ops
+    started = perf_counter()
+    await run(fake_bot)
+    wall = perf_counter() - started
+    db_ops = bot.store.ops - ops
+
+    tracemalloc.start()
+    await run(FakeBot())
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {
+        "wall_ms": round(wall * 1000, 1),
+        "db_ops": db_ops,
+        "tg_calls": len(fake_bot.calls),
+        "peak_kib": round(peak / 1024, 1),
+    }
+
+# ---- Runner ----
+def use_backend(mongo_uri: str | None):
+    """Point the bot's store at mongomock or a plain local mongod"""
+    if mongo_uri:
+        from motor.motor_asyncio import AsyncIOMotorClient
+        bot.store.client = AsyncIOMotorClient(mongo_uri)
+        bot.store.db = bot.store.client[BENCH_DB]
+        return
+    try:
+        from mongomock_motor import AsyncMongoMockClient
+    except ImportError:
+        raise SystemExit("mongomock-motor is required: pip install mongomock-motor (or pass --mongo-uri)")
+    bot.store.db = AsyncMongoMockClient()[BENCH_DB]
+
+def print_table(size: int, results: dict, baseline: dict):
+    print(f"\n== {size:,} purchases ==")
+    print(f"{'handler':<28}{'wall ms':>10}{'db ops':>8}{'tg calls':>10}{'peak KiB':>11}")
+    for name, row in results.items():
+        line = f"{name:<28}{row['wall_ms']:>10}{row['db_ops']:>8}{row['tg_calls']:>10}{row['peak_kib']:>11}"
+        before = baseline.get(str(size), {}).get(name)
+        if before:
+            changes = []
+            for key in ("wall_ms", "db_ops", "tg_calls", "peak_kib"):
+                if before[key]:
+                    changes.append(f"{key} {(row[key] - before[key]) / before[key]:+.0%}")
+            line += "   vs baseline: " + ", ".join(changes)
+        print(line)
+
+async def run_benchmark(args) -> dict:
+    use_backend(args.mongo_uri)
+    # Flood limits are not what is being measured here
+    bot.dispatcher = bot.NotificationDispatcher(1e9, 1e9, 0)
+    bot.date_migration_done = True
+    bot.db_available = True
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    report = {}
+    for size in args.sizes:
+        started = perf_counter()
+        await seed(size, args.seed)
+        print(f"\nSeeded {size:,} purchases in {perf_counter() - started:.1f}s")
+        results = {}
+        for name, run in scenarios(size).items():
+            results[name] = await measure(run)
+        report[str(size)] = results
+        print_table(size, results, baseline)
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark bot handlers against seeded data")
+    parser.add_argument("--sizes", default="1000,10000,100000",
+                        type=lambda value: [int(v) for v in value.split(",")],
+                        help="comma separated purchase counts")
+    parser.add_argument("--seed", type=int, default=42, help="random seed for the data set")
+    parser.add_argument("--mongo-uri", help="use a local mongod instead of mongomock (database apkbench is wiped)")
+    parser.add_argument("--save", help="write results as JSON to this path")
+    parser.add_argument("--baseline", help="JSON from an earlier --save to compare against")
+    args = parser.parse_args()
+
+    report = asyncio.run(run_benchmark(args))
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nSaved results to {args.save}")
+
+if __name__ == "__main__":
+    main()
@@ -2,20 +2,49 @@ import os
 from dotenv import load_dotenv   # 👈 dotenv import kiya
 
 import asyncio
+import contextlib
+import csv
+import functools
+import gzip
+import heapq
+import hmac
+import io
+import json
+import secrets
+import tempfile
 from datetime import datetime, timedelta, time
-from pymongo import MongoClient
+import threading
+from bisect import bisect_left, insort
+from collections import OrderedDict, deque
+from time import monotonic
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ASCENDING, DeleteOne, ReplaceOne, ReturnDocument, UpdateOne, monitoring
+from pymongo.errors import BulkWriteError, DuplicateKeyError, PyMongoError
+import bson
 from bson import ObjectId
 import certifi
-import re
 
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
+from telegram import (
+    InlineKeyboardButton,
+    InlineKeyboardMarkup,
+    InlineQueryResultArticle,
+    InputTextMessageContent,
+    Update,
+)
+from telegram.error import NetworkError, RetryAfter, TelegramError
+from telegram.request import HTTPXRequest
 from telegram.ext import (
+    Application,
     ApplicationBuilder,
+    BasePersistence,
     CallbackQueryHandler,
     CommandHandler,
     ConversationHandler,
     ContextTypes,
+    InlineQueryHandler,
     MessageHandler,
+    PersistenceInput,
+    PicklePersistence,
     filters,
 )
 
@@ -30,41 +59,506 @@ BOT_TOKEN = os.getenv("BOT_TOKEN")        # ✅ Env variable se token lo
 MONGO_URI = os.getenv("MONGO_URI")
 DELETE_PASS = os.getenv("DELETE_PASS", "143143")
 SUPER_ADMIN_ID = int(os.getenv("SUPER_ADMIN_ID", "8367405986"))
+BOT_MODE = os.getenv("BOT_MODE", "polling")  # "polling" or "webhook"
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")  # public https base URL, e.g. https://bot.example.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")  # required in webhook mode
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "")  # e.g. a local Bot API server; default api.telegram.org
+PORT = int(os.getenv("PORT", "8000"))
+RUN_SCHEDULER = os.getenv("RUN_SCHEDULER", "1") == "1"  # set "0" on extra instances
+PERSISTENCE = os.getenv("PERSISTENCE", "mongo")  # "mongo", "file" or "none"
+PERSISTENCE_FILE = os.getenv("PERSISTENCE_FILE", "bot_state.pickle")
+PERSISTENCE_INTERVAL = float(os.getenv("PERSISTENCE_INTERVAL", "30"))  # seconds between write-behind flushes
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "8"))  # handlers running at once
 ADMIN_IDS = [7045858363, 6127512234]  # 😟normal admin😟
 
-db_available = True
-try:
-    mongo = MongoClient(
-        MONGO_URI,
-        serverSelectionTimeoutMS=10000,
-        tls=True,
-        tlsAllowInvalidCertificates=False,
-        tlsCAFile=certifi.where()
-    )
+MONGO_POOL_SIZE = int(os.getenv("MONGO_POOL_SIZE", "20"))
+MONGO_OP_TIMEOUT = float(os.getenv("MONGO_OP_TIMEOUT", "5"))  # seconds per DB operation
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # polling mode: serve metrics on this port (0 = off)
+METRICS_PATH = os.getenv("METRICS_PATH", "/metrics")
+EXPORT_CONCURRENCY = int(os.getenv("EXPORT_CONCURRENCY", "2"))  # exports running at once
+
+# ---- Metrics ----
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)  # seconds
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+class LatencyHistogram:
+    """Fixed-bucket latency histogram (Prometheus style, cumulative on render)"""
+
+    __slots__ = ("counts", "total", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)  # last slot is +Inf
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, seconds: float):
+        self.counts[bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.total += seconds
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket holding the q-th observation"""
+        target = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if n and seen >= target:
+                return LATENCY_BUCKETS[i] if i < len(LATENCY_BUCKETS) else float("inf")
+        return 0.0
+
+class MetricsRegistry:
+    """Latency histograms, error counters and in-flight gauges per (kind, name).
+
+    Kinds are handler, job, mongo, telegram and queue (time an update waited
+    before a handler started); render() produces the Prometheus text format
+    and summary() the /Metrics reply. Components with their own counters
+    (the update queue) register a gauge source that render() reads.
+    """
+
+    KINDS = {
+        "handler": "Telegram update handlers",
+        "job": "scheduled jobs",
+        "mongo": "MongoDB operations",
+        "telegram": "Bot API calls",
+        "queue": "update waits before handling",
+    }
+
+    def __init__(self):
+        self.latency: dict[tuple[str, str], LatencyHistogram] = {}
+        self.errors: dict[tuple[str, str], int] = {}
+        self.in_flight: dict[tuple[str, str], int] = {}
+        self.startup: dict[str, float] = {}  # startup step -> seconds
+        self.gauge_sources = []  # callables returning [(metric, type, help, value)]
+        self.started = monotonic()
+
+    def add_gauges(self, source):
+        self.gauge_sources.append(source)
+
+    def observe(self, kind: str, name: str, seconds: float):
+        """Record a duration that was not timed with begin()/end()"""
+        hist = self.latency.get((kind, name))
+        if hist is None:
+            hist = self.latency[(kind, name)] = LatencyHistogram()
+        hist.observe(seconds)
+
+    def mark_startup(self, step: str, seconds: float):
+        self.startup[step] = seconds
+
+    def begin(self, kind: str, name: str) -> float:
+        key = (kind, name)
+        self.in_flight[key] = self.in_flight.get(key, 0) + 1
+        return monotonic()
+
+    def end(self, kind: str, name: str, started: float, error: bool = False):
+        key = (kind, name)
+        self.in_flight[key] -= 1
+        self.observe(kind, name, monotonic() - started)
+        if error:
+            self.errors[key] = self.errors.get(key, 0) + 1
+
+    def render(self) -> str:
+        lines = [
+            "# HELP bot_uptime_seconds Seconds since the process started",
+            "# TYPE bot_uptime_seconds gauge",
+            f"bot_uptime_seconds {monotonic() - self.started:.3f}",
+            "# HELP bot_startup_seconds Duration of each startup step",
+            "# TYPE bot_startup_seconds gauge",
+        ]
+        for step, seconds in self.startup.items():
+            lines.append(f'bot_startup_seconds{{step="{step}"}} {seconds:.3f}')
+        for source in self.gauge_sources:
+            for metric, metric_type, help_text, value in source():
+                lines.append(f"# HELP {metric} {help_text}")
+                lines.append(f"# TYPE {metric} {metric_type}")
+                lines.append(f"{metric} {value}")
+        for kind, help_text in self.KINDS.items():
+            prefix = f"bot_{kind}"
+            lines.append(f"# HELP {prefix}_seconds Latency of {help_text}")
+            lines.append(f"# TYPE {prefix}_seconds histogram")
+            for (k, name), hist in sorted(self.latency.items()):
+                if k != kind:
+                    continue
+                cumulative = 0
+                for bound, n in zip(LATENCY_BUCKETS + ("+Inf",), hist.counts):
+                    cumulative += n
+                    lines.append(f'{prefix}_seconds_bucket{{name="{name}",le="{bound}"}} {cumulative}')
+                lines.append(f'{prefix}_seconds_sum{{name="{name}"}} {hist.total:.6f}')
+                lines.append(f'{prefix}_seconds_count{{name="{name}"}} {hist.count}')
+            lines.append(f"# HELP {prefix}_errors_total Failed {help_text}")
+            lines.append(f"# TYPE {prefix}_errors_total counter")
+            for (k, name), n in sorted(self.errors.items()):
+                if k == kind:
+                    lines.append(f'{prefix}_errors_total{{name="{name}"}} {n}')
+            lines.append(f"# HELP {prefix}_in_flight {help_text} currently running")
+            lines.append(f"# TYPE {prefix}_in_flight gauge")
+            for (k, name), n in sorted(self.in_flight.items()):
+                if k == kind:
+                    lines.append(f'{prefix}_in_flight{{name="{name}"}} {n}')
+        return "\n".join(lines) + "\n"
+
+    def summary(self, top: int = 5) -> list[str]:
+        """Slowest series per kind by total time: calls, avg, p95 bound, errors"""
+        lines = []
+        if self.startup:
+            steps = " | ".join(f"{step} {seconds:.2f}s" for step, seconds in self.startup.items())
+            lines.extend([f"🚀 Startup: {steps}", ""])
+        for kind in self.KINDS:
+            series = [(name, hist) for (k, name), hist in self.latency.items() if k == kind]
+            if not series:
+                continue
+            running = sum(n for (k, _), n in self.in_flight.items() if k == kind)
+            lines.append(f"▶ {kind} ({running} in flight)")
+            series.sort(key=lambda item: item[1].total, reverse=True)
+            for name, hist in series[:top]:
+                p95 = hist.quantile(0.95)
+                p95_text = f"≤{p95 * 1000:.0f}ms" if p95 != float("inf") else f">{LATENCY_BUCKETS[-1]:.0f}s"
+                errors = self.errors.get((kind, name), 0)
+                lines.append(f"  {name}: {hist.count}x | avg {hist.total / hist.count * 1000:.0f}ms | p95 {p95_text} | {errors} err")
+            lines.append("")
+        return lines
+
+metrics = MetricsRegistry()
+
+def instrumented(callback, kind: str = "handler"):
+    """Wrap a handler or job callback so each call is timed and counted"""
+    name = callback.__name__
+
+    @functools.wraps(callback)
+    async def wrapper(*args, **kwargs):
+        started = metrics.begin(kind, name)
+        error = False
+        try:
+            return await callback(*args, **kwargs)
+        except Exception:
+            error = True
+            raise
+        finally:
+            metrics.end(kind, name, started, error)
+    return wrapper
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPXRequest that records latency and failures per Bot API method"""
+
+    async def do_request(self, url: str, method: str, request_data=None, *args, **kwargs):
+        name = url.rsplit("/", 1)[-1]
+        started = metrics.begin("telegram", name)
+        error = True
+        try:
+            code, payload = await super().do_request(url, method, request_data, *args, **kwargs)
+            error = code >= 400
+            return code, payload
+        finally:
+            metrics.end("telegram", name, started, error)
+
+class MetricsServer:
+    """Minimal HTTP listener serving METRICS_PATH for Prometheus in polling mode"""
+
+    def __init__(self, port: int):
+        self.port = port
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._handle, "0.0.0.0", self.port)
+        print(f"📈 Metrics on :{self.port}{METRICS_PATH}")
+
+    async def _handle(self, reader, writer):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), 5)
+            while (await asyncio.wait_for(reader.readline(), 5)).strip():
+                pass  # headers are not needed
+            parts = request_line.decode(errors="replace").split()
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == METRICS_PATH:
+                status, body = "200 OK", metrics.render().encode()
+            else:
+                status, body = "404 Not Found", b"not found\n"
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: {PROMETHEUS_CONTENT_TYPE}\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+        except Exception:
+            pass
+        finally:
+            writer.close()
+
+    async def close(self):
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+metrics_server = MetricsServer(METRICS_PORT) if METRICS_PORT and BOT_MODE != "webhook" else None
+
+# ---- Async Data Access Layer ----
+class PoolMonitor(monitoring.ConnectionPoolListener):
+    """Tracks connection pool usage (callbacks arrive on driver threads)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.open = 0
+        self.in_use = 0
+        self.waiting = 0
+        self.checkout_failed = 0
+
+    def _add(self, attr: str, delta: int):
+        with self._lock:
+            setattr(self, attr, getattr(self, attr) + delta)
+
+    def connection_created(self, event):
+        self._add("open", 1)
+
+    def connection_closed(self, event):
+        self._add("open", -1)
+
+    def connection_check_out_started(self, event):
+        self._add("waiting", 1)
+
+    def connection_checked_out(self, event):
+        self._add("waiting", -1)
+        self._add("in_use", 1)
+
+    def connection_check_out_failed(self, event):
+        self._add("waiting", -1)
+        self._add("checkout_failed", 1)
+
+    def connection_checked_in(self, event):
+        self._add("in_use", -1)
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
 
-    mongo.admin.command("ping")
-    db = mongo["apkdata"]
-    collection = db["purchases"]
-    activity_logs = db["activity_logs"]
-    admins_collection = db["admins"]
-except Exception as e:
-    print("⚠ MongoDB connect fail:", e)
-    db_available = False
-    collection = None
-    activity_logs = None
-    admins_collection = None
+    def connection_ready(self, event):
+        pass
+
+class MongoStore:
+    """Async access to the bot's collections with a bounded pool and per-operation timeouts.
+
+    Nothing touches the network at construction; connect() builds the client
+    (off the event loop, mongodb+srv URIs do DNS lookups) and pings it.
+    """
+
+    def __init__(self, uri: str, pool_size: int, op_timeout: float):
+        self.uri = uri
+        self.pool = PoolMonitor()
+        self.pool_size = pool_size
+        self.op_timeout = op_timeout
+        self.client = None
+        self.db = None
+        self._connecting = None  # client creation still running in its thread
+        self.ops = 0
+        self.timeouts = 0
+
+    def _new_client(self):
+        return AsyncIOMotorClient(
+            self.uri,
+            maxPoolSize=self.pool_size,
+            waitQueueTimeoutMS=int(self.op_timeout * 1000),
+            serverSelectionTimeoutMS=10000,
+            tls=True,
+            tlsAllowInvalidCertificates=False,
+            tlsCAFile=certifi.where(),
+            event_listeners=[self.pool],
+        )
+
+    async def connect(self, timeout: float):
+        """Create the client on first use, then check the server answers"""
+        if self.db is None:
+            if self._connecting is None:
+                self._connecting = asyncio.ensure_future(asyncio.to_thread(self._new_client))
+            # A timeout leaves the thread running; the next attempt picks up the
+            # same client instead of starting (and leaking) another one
+            try:
+                client = await asyncio.wait_for(asyncio.shield(self._connecting), timeout)
+            except asyncio.TimeoutError:
+                raise
+            except Exception:
+                self._connecting = None
+                raise
+            self._connecting = None
+            self.client = client
+            self.db = client["apkdata"]
+        await self.ping(timeout=timeout)
+
+    async def _run(self, op: str, aw, timeout: float | None):
+        self.ops += 1
+        started = metrics.begin("mongo", op)
+        error = True
+        try:
+            result = await asyncio.wait_for(aw, timeout or self.op_timeout)
+            error = False
+            return result
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            raise
+        finally:
+            metrics.end("mongo", op, started, error)
+
+    async def ping(self, timeout: float | None = None):
+        return await self._run("ping", self.client.admin.command("ping"), timeout)
+
+    async def find_one(self, coll: str, filter: dict, projection: dict = None, timeout: float = None):
+        return await self._run(f"{coll}.find_one", self.db[coll].find_one(filter, projection), timeout)
+
+    async def find(self, coll: str, filter: dict, projection: dict = None, sort: list = None,
+                   skip: int = 0, limit: int = 0, timeout: float = None) -> list:
+        cursor = self.db[coll].find(filter, projection, skip=skip, limit=limit)
+        if sort:
+            cursor = cursor.sort(sort)
+        return await self._run(f"{coll}.find", cursor.to_list(length=None), timeout)
+
+    async def iterate(self, coll: str, filter: dict, projection: dict = None, sort: list = None,
+                      batch_size: int = 200, timeout: float = None):
+        """Yield documents lazily; only one server batch is held in memory"""
+        cursor = self.db[coll].find(filter, projection, batch_size=batch_size)
+        if sort:
+            cursor = cursor.sort(sort)
+        try:
+            while True:
+                batch = await self._run(f"{coll}.iterate", cursor.to_list(length=batch_size), timeout)
+                if not batch:
+                    return
+                for doc in batch:
+                    yield doc
+        finally:
+            await cursor.close()
+
+    async def count(self, coll: str, filter: dict, timeout: float = None) -> int:
+        return await self._run(f"{coll}.count", self.db[coll].count_documents(filter), timeout)
+
+    async def aggregate(self, coll: str, pipeline: list, timeout: float = None) -> list:
+        return await self._run(f"{coll}.aggregate", self.db[coll].aggregate(pipeline).to_list(length=None), timeout)
+
+    async def insert_one(self, coll: str, document: dict, timeout: float = None):
+        return await self._run(f"{coll}.insert_one", self.db[coll].insert_one(document), timeout)
+
+    async def insert_many(self, coll: str, documents: list, timeout: float = None):
+        return await self._run(f"{coll}.insert_many", self.db[coll].insert_many(documents, ordered=False), timeout)
+
+    async def update_one(self, coll: str, filter: dict, update, upsert: bool = False, timeout: float = None):
+        return await self._run(f"{coll}.update_one", self.db[coll].update_one(filter, update, upsert=upsert), timeout)
+
+    async def find_one_and_update(self, coll: str, filter: dict, update, projection: dict = None,
+                                  timeout: float = None):
+        return await self._run(
+            f"{coll}.find_one_and_update",
+            self.db[coll].find_one_and_update(filter, update, projection, return_document=ReturnDocument.AFTER),
+            timeout,
+        )
+
+    async def bulk_write(self, coll: str, requests: list, timeout: float = None):
+        return await self._run(f"{coll}.bulk_write", self.db[coll].bulk_write(requests, ordered=False), timeout)
+
+    async def create_index(self, coll: str, keys: list, timeout: float = None, **kwargs):
+        return await self._run(f"{coll}.create_index", self.db[coll].create_index(keys, **kwargs), timeout)
+
+    def stats(self) -> dict:
+        return {
+            "pool_size": self.pool_size,
+            "open": self.pool.open,
+            "in_use": self.pool.in_use,
+            "waiting": self.pool.waiting,
+            "checkout_failed": self.pool.checkout_failed,
+            "ops": self.ops,
+            "timeouts": self.timeouts,
+        }
+
+# Named projection profiles: every read fetches only the fields its caller uses,
+# so the ever-growing payments array stays on the server unless it is rendered.
+HISTORY_MAX_PAYMENTS = 5  # latest payments shown per record
+
+PROJECTIONS = {
+    # admins
+    "admin_id": {"_id": 0, "user_id": 1},
+    "admin_list": {"_id": 0, "user_id": 1, "username": 1},
+    # purchases
+    "exists": {"_id": 1},
+    "owner_check": {"owner_id": 1},
+    "due_check": {"due_amount": 1},
+    "owner_due": {"owner_id": 1, "due_amount": 1},
+    "history": {
+        "client_name": 1, "apk_name": 1, "purchase_date": 1, "expiry_date": 1,
+        "total_price": 1, "due_amount": 1, "status": 1, "owner_id": 1,
+        # one extra so the renderer knows older payments exist
+        "payments": {"$slice": -(HISTORY_MAX_PAYMENTS + 1)},
+    },
+    "expiry_schedule": {"client_name": 1, "apk_name": 1, "owner_id": 1, "expiry_date": 1},
+    "export": {
+        "client_name": 1, "apk_name": 1, "owner_id": 1, "status": 1, "purchase_date": 1,
+        "expiry_date": 1, "total_price": 1, "due_amount": 1, "payments": 1,
+    },
+    "client_due": {"_id": 0, "apk_name": 1, "total_price": 1, "due_amount": 1, "payments": 1},
+    "due_entry": {"_id": 0, "owner_id": 1, "client_name": 1, "apk_name": 1, "total_price": 1, "due_amount": 1},
+    "payment_result": {"owner_id": 1, "due_amount": 1, "payments": {"$slice": -1}},
+    "delete_result": {"client_name": 1, "apk_name": 1, "owner_id": 1, "due_amount": 1},
+    "client_key_backfill": {"client_name": 1},
+    # clients directory
+    "client_directory": {"name": 1, "owners": 1},
+    "date_backfill": {"purchase_date": 1, "expiry_date": 1, "created_at": 1},
+    # meta / sessions
+    "marker": {"done": 1},
+    "callback_token": {"_id": 0, "data": 1, "created_at": 1},
+    "watermark": {"at": 1},
+    "session_user": {"_id": 0, "key": 1, "data": 1},
+    "session_conv": {"_id": 0, "key": 1, "state": 1},
+}
+
+db_available = False  # flipped by db_supervisor once Mongo answers
+store = MongoStore(MONGO_URI, MONGO_POOL_SIZE, MONGO_OP_TIMEOUT) if MONGO_URI else None
+if store is None:
+    print("⚠ MONGO_URI not set, DB features disabled")
 
 ASK_NICK, ASK_DATE, ASK_APK, ASK_DELETE_PASS, ASK_PAYMENT_DATE, EDIT_INLINE, ASK_PRICE, ASK_PARTIAL_AMOUNT, ASK_OWNER_SELECTION = range(9)
 
+DATE_FIELDS = ("purchase_date", "expiry_date", "created_at")
+date_migration_done = False  # flips once every stored date is a BSON datetime
+
 def fmt(dt: datetime) -> str:
     return dt.strftime("%Y-%m-%d %H:%M:%S")
 
+def as_datetime(value) -> datetime | None:
+    """Stored date -> datetime (legacy records keep fmt() strings until migrated)"""
+    if isinstance(value, datetime):
+        return value
+    if isinstance(value, str):
+        try:
+            return datetime.strptime(value, "%Y-%m-%d %H:%M:%S")
+        except ValueError:
+            return None
+    return None
+
+def fmt_stored(value) -> str:
+    dt = as_datetime(value)
+    return fmt(dt) if dt else "-"
+
 def parse_ddmmyyyy(s: str) -> datetime | None:
     try:
         return datetime.strptime(s.strip(), "%d/%m/%Y")
     except:
         return None
 
+def normalize_client_name(name: str) -> str:
+    """Lookup key for client names (trimmed + case-folded)"""
+    return (name or "").strip().casefold()
+
+background_tasks = set()
+
+def spawn_background(coro):
+    """Run a coroutine in the background, keeping a reference until it finishes"""
+    task = asyncio.get_running_loop().create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
 def _msg_from_update(update: Update):
     if update.message:
         return update.message
@@ -72,30 +566,104 @@ def _msg_from_update(update: Update):
         return update.callback_query.message
     return None
 
+# ---- Admin Registry Cache ----
+ADMIN_CACHE_TTL = int(os.getenv("ADMIN_CACHE_TTL", "300"))  # seconds
+
+class AdminRegistry:
+    """In-memory set of active admin IDs so access checks don't hit MongoDB"""
+
+    def __init__(self, ttl: int):
+        self.ttl = ttl
+        self.admin_ids: set[int] = set()
+        self.loaded_at: datetime | None = None
+        self.hits = 0
+        self.misses = 0
+        self._lock = asyncio.Lock()
+        self._refresh_task = None
+        self.generation = 0  # bumped by add/discard/invalidate
+
+    def is_fresh(self) -> bool:
+        if self.loaded_at is None:
+            return False
+        return (datetime.now() - self.loaded_at).total_seconds() < self.ttl
+
+    async def refresh(self):
+        """Reload active admin IDs from DB"""
+        async with self._lock:
+            if self.is_fresh():
+                return
+            while True:
+                # A change made while we were reading would be lost; read again
+                generation = self.generation
+                admins = await store.find("admins", {"status": "active"}, PROJECTIONS["admin_id"])
+                if generation == self.generation:
+                    break
+            self.admin_ids = {a["user_id"] for a in admins if "user_id" in a}
+            self.loaded_at = datetime.now()
+
+    def _refresh_in_background(self):
+        if self._refresh_task and not self._refresh_task.done():
+            return
+        self._refresh_task = spawn_background(self._safe_refresh())
+
+    async def _safe_refresh(self):
+        try:
+            await self.refresh()
+        except Exception as e:
+            print(f"⚠ Admin registry refresh error: {e}")
+
+    async def contains(self, user_id: int) -> bool:
+        """Cached membership check; a stale cache is served while it reloads"""
+        if self.loaded_at is None:
+            self.misses += 1
+            await self.refresh()
+        else:
+            self.hits += 1
+            if not self.is_fresh():
+                self._refresh_in_background()
+        return user_id in self.admin_ids
+
+    def add(self, user_id: int):
+        self.generation += 1
+        self.admin_ids.add(user_id)
+
+    def discard(self, user_id: int):
+        self.generation += 1
+        self.admin_ids.discard(user_id)
+
+    def invalidate(self):
+        """Force a reload on the next access check"""
+        self.generation += 1
+        self.loaded_at = None
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "size": len(self.admin_ids)}
+
+admin_registry = AdminRegistry(ADMIN_CACHE_TTL)
+
 # Enhanced user access check
 async def is_user_registered(user_id: int) -> bool:
     """Check if user is registered to use bot"""
-    if not db_available or admins_collection is None:
-        return user_id == SUPER_ADMIN_ID
-    
     if user_id == SUPER_ADMIN_ID:
         return True
-
     
+    if not db_available or store is None:
+        # Outage: keep letting in the admins loaded before it started
+        return user_id in admin_registry.admin_ids
+
     try:
-        admin = await asyncio.to_thread(admins_collection.find_one, {"user_id": user_id})
-        return admin is not None
+        return await admin_registry.contains(user_id)
     except:
         return False
 
 # Save admin to database
 async def save_admin_to_db(user_id: int, username: str = None):
     """Save admin to database"""
-    if not db_available or admins_collection is None:
+    if not db_available or store is None:
         return
     
     try:
-        existing = await asyncio.to_thread(admins_collection.find_one, {"user_id": user_id})
+        existing = await store.find_one("admins", {"user_id": user_id}, PROJECTIONS["exists"])
         if not existing:
             admin_data = {
                 "user_id": user_id,
@@ -103,18 +671,20 @@ async def save_admin_to_db(user_id: int, username: str = None):
                 "added_date": fmt(datetime.now()),
                 "status": "active"
             }
-            await asyncio.to_thread(admins_collection.insert_one, admin_data)
+            await store.insert_one("admins", admin_data)
+            admin_registry.add(user_id)
     except Exception as e:
+        admin_registry.invalidate()
         print(f"⚠ Error saving admin: {e}")
 
 # Get all registered admins
 async def get_all_admins():
     """Get all registered admins"""
-    if not db_available or admins_collection is None:
+    if not db_available or store is None:
         return []
     
     try:
-        admins = await asyncio.to_thread(lambda: list(admins_collection.find({"status": "active"})))
+        admins = await store.find("admins", {"status": "active"}, PROJECTIONS["admin_list"])
         return admins
     except:
         return []
@@ -134,31 +704,421 @@ async def check_access(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bo
         return False
     return True
 
+# ---- Activity Log Sink ----
+LOG_BUFFER_SIZE = int(os.getenv("LOG_BUFFER_SIZE", "5000"))
+LOG_BATCH_SIZE = int(os.getenv("LOG_BATCH_SIZE", "100"))
+LOG_FLUSH_INTERVAL = float(os.getenv("LOG_FLUSH_INTERVAL", "5"))  # seconds
+
+class ActivityLogSink:
+    """Buffers activity log entries in memory and writes them with insert_many.
+
+    Flushes when LOG_BATCH_SIZE entries are queued or every LOG_FLUSH_INTERVAL
+    seconds. When the buffer is full the oldest entry is dropped (and counted).
+    """
+
+    def __init__(self, max_size: int, batch_size: int, flush_interval: float):
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.buffer = deque()
+        self.written = 0
+        self.dropped = 0
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task = None
+
+    def put(self, entry: dict):
+        if len(self.buffer) >= self.max_size:
+            self.buffer.popleft()
+            self.dropped += 1
+        self.buffer.append(entry)
+        if len(self.buffer) >= self.batch_size:
+            self._wakeup.set()
+
+    def start(self):
+        if self._task is None:
+            self._task = spawn_background(self._run())
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    async def flush(self):
+        """Write out everything buffered; on DB error entries go back to the front"""
+        async with self._flush_lock:
+            while self.buffer and db_available and store is not None:
+                batch = [self.buffer.popleft() for _ in range(min(self.batch_size, len(self.buffer)))]
+                try:
+                    await store.insert_many("activity_logs", batch)
+                    self.written += len(batch)
+                except BulkWriteError as e:
+                    # Unordered insert: everything not listed went in, and a duplicate _id
+                    # means an earlier (timed out) attempt already wrote that entry
+                    failed = {
+                        err["index"] for err in (e.details or {}).get("writeErrors", [])
+                        if err.get("code") != 11000
+                    }
+                    self.written += len(batch) - len(failed)
+                    if failed:
+                        print(f"⚠ Activity log flush error: {len(failed)} entries failed")
+                        self._requeue([doc for i, doc in enumerate(batch) if i in failed])
+                        return
+                except Exception as e:
+                    print(f"⚠ Activity log flush error: {e}")
+                    # Entries keep their _id, so a retry can tell what already went in
+                    self._requeue(batch)
+                    return
+
+    def _requeue(self, batch: list):
+        self.buffer.extendleft(reversed(batch))
+        while len(self.buffer) > self.max_size:
+            self.buffer.popleft()
+            self.dropped += 1
+
+    async def close(self):
+        if self._task:
+            # Wait for an in-flight insert so the batch it popped is not lost
+            async with self._flush_lock:
+                self._task.cancel()
+            self._task = None
+        await self.flush()
+
+    def stats(self) -> dict:
+        return {"queued": len(self.buffer), "written": self.written, "dropped": self.dropped}
+
+activity_sink = ActivityLogSink(LOG_BUFFER_SIZE, LOG_BATCH_SIZE, LOG_FLUSH_INTERVAL)
+
 # Activity Logging Function
 async def log_activity(action: str, admin_id: int, details: dict = None):
-    """Log admin activities"""
-    if not db_available or activity_logs is None:
+    """Log admin activities (queued, written in the background)"""
+    if store is None:
         return
     
-    try:
-        log_entry = {
-            "action": action,
-            "admin_id": admin_id,
-            "timestamp": fmt(datetime.now()),
-            "details": details or {}
-        }
-        await asyncio.to_thread(activity_logs.insert_one, log_entry)
-    except Exception as e:
-        print(f"⚠ Activity log error: {e}")
+    activity_sink.put({
+        "action": action,
+        "admin_id": admin_id,
+        "timestamp": fmt(datetime.now()),
+        "details": details or {}
+    })
+
+# ---- Notification Dispatcher ----
+NOTIFY_GLOBAL_RATE = float(os.getenv("NOTIFY_GLOBAL_RATE", "30"))  # messages/sec, all chats
+NOTIFY_CHAT_RATE = float(os.getenv("NOTIFY_CHAT_RATE", "1"))  # messages/sec, per chat
+NOTIFY_MAX_RETRIES = int(os.getenv("NOTIFY_MAX_RETRIES", "3"))
+
+class TokenBucket:
+    """Async token bucket: acquire() waits until a token is available"""
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity or max(rate, 1)
+        self.tokens = self.capacity
+        self.updated = monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+def new_dispatch_report() -> dict:
+    return {"delivered": 0, "retried": 0, "failed": 0}
+
+class NotificationDispatcher:
+    """Sends bot messages within Telegram flood limits.
+
+    A global bucket (~30 msg/s) and a per-chat bucket throttle sends; chats are
+    served concurrently while each chat's messages keep their order. RetryAfter
+    and network errors are retried up to NOTIFY_MAX_RETRIES times.
+    """
+
+    def __init__(self, global_rate: float, chat_rate: float, max_retries: int):
+        self.chat_rate = chat_rate
+        self.max_retries = max_retries
+        self.global_bucket = TokenBucket(global_rate)
+        self.chat_buckets: dict[int, TokenBucket] = {}
+        self.totals = new_dispatch_report()
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        if chat_id not in self.chat_buckets:
+            self.chat_buckets[chat_id] = TokenBucket(self.chat_rate)
+        return self.chat_buckets[chat_id]
+
+    def _count(self, report: dict, key: str):
+        report[key] += 1
+        self.totals[key] += 1
+
+    async def _send(self, bot, chat_id: int, text: str, report: dict) -> bool:
+        attempt = 0
+        while True:
+            await self._chat_bucket(chat_id).acquire()
+            await self.global_bucket.acquire()
+            try:
+                await bot.send_message(chat_id=chat_id, text=text)
+                self._count(report, "delivered")
+                return True
+            except RetryAfter as e:
+                wait = e.retry_after
+            except NetworkError:
+                wait = 2 ** attempt
+            except TelegramError as e:
+                # Blocked bot, chat not found, bad request: retrying won't help
+                print(f"⚠ Notification error for admin {chat_id}: {e}")
+                self._count(report, "failed")
+                return False
+            attempt += 1
+            if attempt > self.max_retries:
+                print(f"⚠ Notification to {chat_id} gave up after {self.max_retries} retries")
+                self._count(report, "failed")
+                return False
+            self._count(report, "retried")
+            await asyncio.sleep(wait)
+
+    async def _send_chat(self, bot, chat_id: int, texts: list[str], report: dict):
+        for text in texts:
+            await self._send(bot, chat_id, text, report)
+
+    async def send(self, bot, chat_id: int, text: str, report: dict = None) -> bool:
+        return await self._send(bot, chat_id, text, report if report is not None else new_dispatch_report())
+
+    async def send_many(self, bot, messages: list[tuple[int, str]]) -> dict:
+        """Fan out (chat_id, text) pairs; returns delivered/retried/failed counts"""
+        report = new_dispatch_report()
+        per_chat: dict[int, list[str]] = {}
+        for chat_id, text in messages:
+            per_chat.setdefault(chat_id, []).append(text)
+        await asyncio.gather(*(self._send_chat(bot, chat_id, texts, report) for chat_id, texts in per_chat.items()))
+        return report
+
+dispatcher = NotificationDispatcher(NOTIFY_GLOBAL_RATE, NOTIFY_CHAT_RATE, NOTIFY_MAX_RETRIES)
 
 # Notification Function
 async def send_notification(context, admin_id: int, message: str):
     """Send notification to admin"""
     try:
-        await context.bot.send_message(chat_id=admin_id, text=message)
+        await dispatcher.send(context.bot, admin_id, message)
     except Exception as e:
         print(f"⚠ Notification error for admin {admin_id}: {e}")
 
+# ---- Report Writer ----
+REPORT_CHUNK_SIZE = 3800  # stays clear of Telegram's 4096 character limit
+
+class ReportWriter:
+    """Collects report lines and sends a message each time a chunk fills up.
+
+    Only the current chunk is kept in memory, so a report streamed from a
+    cursor stays flat however many rows it has. Blocks passed to write()
+    are kept together in one message whenever they fit.
+    """
+
+    def __init__(self, send, header: list[str] = None, limit: int = REPORT_CHUNK_SIZE):
+        self.send = send  # async callable taking the message text
+        self.limit = limit
+        self.lines: list[str] = []
+        self.length = 0
+        self.sent = 0
+        self.rows = 0
+        self.header = header or []
+        self.lines.extend(self.header)
+        self.length = sum(len(line) + 1 for line in self.header)
+
+    async def write(self, *lines: str):
+        size = sum(len(line) + 1 for line in lines)
+        if self.lines and self.length + size > self.limit:
+            await self.flush()
+        for line in lines:
+            if len(line) > self.limit:
+                await self.flush()  # keep the lines before it in order
+            while len(line) > self.limit:
+                await self._send_text(line[:self.limit])
+                line = line[self.limit:]
+            if self.length + len(line) + 1 > self.limit:
+                await self.flush()
+            self.lines.append(line)
+            self.length += len(line) + 1
+        self.rows += 1
+
+    async def _send_text(self, text: str):
+        if text.strip():
+            await self.send(text)
+            self.sent += 1
+
+    async def flush(self):
+        text = "\n".join(self.lines).strip("\n")
+        self.lines = []
+        self.length = 0
+        await self._send_text(text)
+
+    async def close(self, *footer: str) -> int:
+        """Append the footer, send what is left and return the message count"""
+        if footer:
+            await self.write(*footer)
+        await self.flush()
+        return self.sent
+
+def chat_sender(bot, chat_id: int, report: dict):
+    async def send(text: str):
+        await dispatcher.send(bot, chat_id, text, report)
+    return send
+
+DUE_QUERY = {"status": "active", "due_amount": {"$gt": 0}}
+
+# ---- Due Ledger ----
+# due_ledger keeps one small doc per owner, {_id: owner_id, total_due, count},
+# moved by $inc next to every purchase write so report headers never scan
+# purchases. /Reconcile rebuilds it if a crash left it out of step.
+
+class LedgerGate:
+    """Purchase writes run side by side, but never while the ledger is rebuilt.
+
+    A rebuild aggregates purchases and then replaces the ledger; an $inc
+    landing in between would be lost (or counted twice), so the rebuild waits
+    for in-flight writes to finish and holds new ones back until it is done.
+    """
+
+    def __init__(self):
+        self.writers = 0
+        self.rebuilding = False
+        self._cond = asyncio.Condition()
+
+    @contextlib.asynccontextmanager
+    async def write(self):
+        async with self._cond:
+            await self._cond.wait_for(lambda: not self.rebuilding)
+            self.writers += 1
+        try:
+            yield
+        finally:
+            async with self._cond:
+                self.writers -= 1
+                self._cond.notify_all()
+
+    @contextlib.asynccontextmanager
+    async def rebuild(self):
+        async with self._cond:
+            await self._cond.wait_for(lambda: not self.rebuilding)
+            self.rebuilding = True
+            await self._cond.wait_for(lambda: self.writers == 0)
+        try:
+            yield
+        finally:
+            async with self._cond:
+                self.rebuilding = False
+                self._cond.notify_all()
+
+ledger_gate = LedgerGate()
+
+async def ledger_write(write, delta):
+    """Await a purchase write, then apply delta(result) -> (owner_id, amount, count) or None"""
+    async with ledger_gate.write():
+        result = await write
+        change = delta(result)
+        if change:
+            await ledger_apply(*change)
+        return result
+
+async def ledger_apply(owner_id: int | None, amount: float, count: int = 0):
+    """Adjust an owner's open dues; a failure is logged and fixed by /Reconcile"""
+    if not amount and not count:
+        return
+    inline_cache.clear()  # cached inline answers show dues
+    try:
+        await store.update_one(
+            "due_ledger", {"_id": owner_id or SUPER_ADMIN_ID},
+            {"$inc": {"total_due": amount, "count": count}}, upsert=True,
+        )
+    except Exception as e:
+        print(f"⚠ Due ledger update error (run /Reconcile): {e}")
+
+async def fetch_due_totals() -> list[dict]:
+    """Per-owner pending dues from the ledger: [{_id: owner_id, total_due, count}]"""
+    totals = await store.find("due_ledger", {"count": {"$gt": 0}}, sort=[("_id", ASCENDING)])
+    for group in totals:
+        group["total_due"] = round(group["total_due"], 2)  # $inc on floats drifts
+    return totals
+
+async def aggregate_due_totals() -> list[dict]:
+    """Per-owner pending dues recomputed from purchases (full scan)"""
+    pipeline = [
+        {"$match": DUE_QUERY},
+        {"$group": {
+            "_id": {"$ifNull": ["$owner_id", SUPER_ADMIN_ID]},
+            "total_due": {"$sum": "$due_amount"},
+            "count": {"$sum": 1},
+        }},
+        {"$sort": {"_id": 1}},
+    ]
+    return await store.aggregate("purchases", pipeline)
+
+async def rebuild_due_ledger() -> dict:
+    """Replace the ledger with totals recomputed from purchases"""
+    async with ledger_gate.rebuild():
+        return await _rebuild_due_ledger()
+
+async def _rebuild_due_ledger() -> dict:
+    totals = await aggregate_due_totals()
+    current = {doc["_id"]: doc for doc in await store.find("due_ledger", {})}
+    ops = []
+    corrected = 0
+    drift = 0.0
+    for group in totals:
+        old = current.pop(group["_id"], {})
+        diff = group["total_due"] - old.get("total_due", 0)
+        if abs(diff) > 0.005 or group["count"] != old.get("count", 0):
+            corrected += 1
+            drift += abs(diff)
+        ops.append(ReplaceOne({"_id": group["_id"]}, {"total_due": group["total_due"], "count": group["count"]}, upsert=True))
+    for owner_id, old in current.items():
+        if old.get("count") or abs(old.get("total_due", 0)) > 0.005:
+            corrected += 1
+            drift += abs(old.get("total_due", 0))
+        ops.append(DeleteOne({"_id": owner_id}))
+    if ops:
+        await store.bulk_write("due_ledger", ops)
+    await store.update_one("meta", {"_id": "due_ledger"}, {"$set": {"done": True, "rebuilt_at": datetime.now()}}, upsert=True)
+    return {"owners": len(totals), "corrected": corrected, "drift": round(drift, 2)}
+
+async def ensure_due_ledger():
+    """Build the ledger once; afterwards it is maintained incrementally"""
+    if await store.find_one("meta", {"_id": "due_ledger"}, PROJECTIONS["marker"]):
+        return
+    result = await rebuild_due_ledger()
+    print(f"✅ Due ledger built ({result['owners']} owners)")
+
+def iterate_dues():
+    return store.iterate("purchases", DUE_QUERY, PROJECTIONS["due_entry"])
+
+async def owner_due_lines(owner_dues: list[dict]) -> list[list[str]]:
+    """One block per owner from the ledger rows (no purchase scan)"""
+    names = {admin.get("user_id"): admin.get("username") for admin in await get_all_admins()}
+    names[SUPER_ADMIN_ID] = "SuperAdmin"
+    return [
+        [
+            f"👨‍💼 Owner: {names.get(group['_id']) or group['_id']} ({group['_id']})",
+            f"📋 Pending entries: {group['count']}",
+            f"⚠ Due: ₹{group['total_due']}",
+            "",
+        ]
+        for group in owner_dues
+    ]
+
+async def owner_writer(bot, owner_id: int, header: list[str], report: dict) -> ReportWriter | None:
+    """ReportWriter for a registered owner's chat, None if the owner isn't registered"""
+    if await is_user_registered(owner_id):
+        return ReportWriter(chat_sender(bot, owner_id, report), header)
+    return None
+
 # Daily Due Payment Notification (3 PM)
 async def daily_due_payment_check(context: ContextTypes.DEFAULT_TYPE):
     """Check for due payments and notify respective admins at 3 PM"""
@@ -166,148 +1126,282 @@ async def daily_due_payment_check(context: ContextTypes.DEFAULT_TYPE):
         return
     
     try:
-        # Find all entries with due_amount > 0 (pending payments)
-        pending_payments = await asyncio.to_thread(lambda: list(
-            collection.find({
-                "status": "active",
-                "due_amount": {"$gt": 0}
-            })
-        ))
+        owner_dues = await fetch_due_totals()
         
-        if not pending_payments:
+        if not owner_dues:
             return
         
-        # Group by owner_id
-        admin_dues = {}
-        super_admin_summary = []
-        total_due = 0
+        report = new_dispatch_report()
+        totals = {group["_id"]: group["total_due"] for group in owner_dues}
+        total_due = round(sum(totals.values()), 2)
+        total_entries = sum(group["count"] for group in owner_dues)
         
-        for entry in pending_payments:
-            owner_id = entry.get("owner_id", SUPER_ADMIN_ID)
-            due_amount = entry.get("due_amount", 0)
-            total_due += due_amount
-            
-            if owner_id not in admin_dues:
-                admin_dues[owner_id] = []
-            
-            admin_dues[owner_id].append({
-                "client_name": entry.get("client_name", "-"),
-                "apk_name": entry.get("apk_name", "-"),
-                "total_price": entry.get("total_price", 0),
-                "due_amount": due_amount
-            })
-            
-            super_admin_summary.append(f"• {entry.get('client_name', '-')} - ₹{due_amount} (Owner: {owner_id})")
+        today = datetime.now().strftime('%d/%m/%Y')
+        # Super admin summary: one block per owner straight from the ledger
+        summary = ReportWriter(
+            chat_sender(context.bot, SUPER_ADMIN_ID, report),
+            [f"📊 DAILY DUE REPORT - {today}", "", f"कुल Pending Amount: ₹{total_due}", ""],
+        )
+        for block in await owner_due_lines(owner_dues):
+            await summary.write(*block)
         
-        # Send notifications to each admin for their dues
-        for owner_id, entries in admin_dues.items():
-            is_registered = await is_user_registered(owner_id)
-            if is_registered:
-                message_lines = ["💰 आपके clients के pending payments:", ""]
-                admin_total = 0
-                
-                for entry in entries:
-                    message_lines.append(f"👤 Client: {entry['client_name']}")
-                    message_lines.append(f"📦 APK: {entry['apk_name']}")
-                    message_lines.append(f"💵 Total: ₹{entry['total_price']}")
-                    message_lines.append(f"⚠ Due: ₹{entry['due_amount']}")
-                    message_lines.append("")
-                    admin_total += entry['due_amount']
-                
-                message_lines.append(f"📊 आपका Total Due: ₹{admin_total}")
-                message_lines.append("कृपया payment collect करें! 🏦")
-                
-                await send_notification(context, owner_id, "\n".join(message_lines))
+        writers = {}
+        for owner_id in totals:
+            writer = await owner_writer(context.bot, owner_id, ["💰 आपके clients के pending payments:", ""], report)
+            if writer:
+                writers[owner_id] = writer
         
-        # Send comprehensive summary to Super Admin
-        if super_admin_summary:
-            today = datetime.now().strftime('%d/%m/%Y')
-            super_message = f"📊 DAILY DUE REPORT - {today}\n\n"
-            super_message += f"कुल Pending Amount: ₹{total_due}\n\n"
-            super_message += "\n".join(super_admin_summary)
-            super_message += f"\n\n🔔 सभी संबंधित admins को notification भेज दी गई है।"
-            
-            await send_notification(context, SUPER_ADMIN_ID, super_message)
+        # Each admin still gets their own clients, streamed from the cursor
+        if writers:
+            async for entry in iterate_dues():
+                owner_id = entry.get("owner_id") or SUPER_ADMIN_ID
+                client_name = entry.get("client_name", "-")
+                writer = writers.get(owner_id)
+                if writer:
+                    await writer.write(
+                        f"👤 Client: {client_name}",
+                        f"📦 APK: {entry.get('apk_name', '-')}",
+                        f"💵 Total: ₹{entry.get('total_price', 0)}",
+                        f"⚠ Due: ₹{entry['due_amount']}",
+                        "",
+                    )
+        
+        await asyncio.gather(*(
+            writer.close(f"📊 आपका Total Due: ₹{totals[owner_id]}", "कृपया payment collect करें! 🏦")
+            for owner_id, writer in writers.items()
+        ))
+        await summary.close("🔔 सभी संबंधित admins को notification भेज दी गई है।")
+        print(f"📨 Due check notifications: {report}")
         
         # Log the due check activity
         await log_activity("due_payment_check", SUPER_ADMIN_ID, {
-            "total_pending_entries": len(pending_payments),
+            "total_pending_entries": total_entries,
             "total_due_amount": total_due,
-            "admins_notified": len(admin_dues)
+            "admins_notified": len(writers),
+            "notifications": report
         })
         
     except Exception as e:
         print(f"⚠ Due payment check error: {e}")
         await send_notification(context, SUPER_ADMIN_ID, f"⚠ Due payment check में error आई: {str(e)}")
 
-# Enhanced Expiry Check Function
-async def check_expiring_apks(context: ContextTypes.DEFAULT_TYPE):
-    """Check for APKs expiring today and notify respective admins"""
-    if not db_available:
-        return
-    
-    try:
-        today = datetime.now().date()
-        today_str = today.strftime("%Y-%m-%d")
-        
-        expiring_apks = await asyncio.to_thread(lambda: list(
-            collection.find({
-                "status": "active",
-                "expiry_date": {"$regex": f"^{today_str}"}
-            })
-        ))
-        
-        if not expiring_apks:
+# ---- Expiry Scheduler ----
+EXPIRY_NOTIFY_HOUR = int(os.getenv("EXPIRY_NOTIFY_HOUR", "9"))  # local hour reminders go out
+EXPIRY_REMINDER_DAYS = sorted(
+    {0} | {int(d) for d in os.getenv("EXPIRY_REMINDER_DAYS", "3,1").split(",") if d.strip()}
+)  # days before expiry; 0 = on the day
+
+class ExpiryScheduler:
+    """Fires expiry reminders at the moment they are due instead of a daily scan.
+
+    Upcoming (record, lead day) reminders sit in a min-heap ordered by fire
+    time; one job_queue timer is armed for the earliest. confirm_cb adds a
+    record's reminders and deletes cancel them. The last fired moment is kept
+    as a watermark in meta, so reminders missed while the bot was down go out
+    right after a restart. Mongo is read in full only once, at startup.
+    """
+
+    def __init__(self, leads: list[int], hour: int):
+        self.leads = leads
+        self.hour = hour
+        self.heap: list[tuple[datetime, int, ObjectId, datetime]] = []  # (fire_at, seq, oid, expiry)
+        self.cancelled: set[ObjectId] = set()
+        self.seq = 0
+        self.app = None
+        self.job = None
+        self.armed_at: datetime | None = None
+        self.watermark: datetime | None = None
+        self.fired = 0
+        self._lock = asyncio.Lock()
+
+    def attach(self, app):
+        """Only the instance running the scheduled jobs fires reminders"""
+        self.app = app
+
+    @property
+    def active(self) -> bool:
+        return self.app is not None and self.app.job_queue is not None and self.watermark is not None
+
+    def _fire_time(self, expiry: datetime, lead: int) -> datetime:
+        return datetime.combine(expiry.date() - timedelta(days=lead), time(hour=self.hour))
+
+    def _push(self, oid: ObjectId, expiry: datetime, after: datetime):
+        for lead in self.leads:
+            fire_at = self._fire_time(expiry, lead)
+            if fire_at > after:
+                self.seq += 1
+                heapq.heappush(self.heap, (fire_at, self.seq, oid, expiry))
+
+    def add(self, oid: ObjectId, expiry_value):
+        """Schedule a newly saved record's reminders"""
+        expiry = as_datetime(expiry_value)
+        if not self.active or expiry is None:
             return
+        self.cancelled.discard(oid)
+        self._push(oid, expiry, max(self.watermark, datetime.now()))
+        self.arm()
+
+    def cancel(self, oid: ObjectId):
+        if self.active:
+            self.cancelled.add(oid)  # entries are dropped lazily when they surface
+
+    async def _load_watermark(self) -> datetime:
+        marker = await store.find_one("meta", {"_id": "expiry_watermark"}, PROJECTIONS["watermark"])
+        if marker and isinstance(marker.get("at"), datetime):
+            return marker["at"]
+        # First run: start from now rather than replaying old expiries
+        now = datetime.now()
+        await self._save_watermark(now)
+        return now
+
+    async def _save_watermark(self, at: datetime):
+        self.watermark = at
+        await store.update_one("meta", {"_id": "expiry_watermark"}, {"$set": {"at": at}}, upsert=True)
+
+    async def load(self):
+        """(Re)build the heap with every reminder after the watermark"""
+        # Never alongside fire_due: reminders it has popped but not yet covered
+        # by the watermark would be pushed back and sent twice
+        async with self._lock:
+            await self._load()
+
+    async def _load(self):
+        if self.app is None or self.app.job_queue is None:
+            return
+        if self.watermark is None:
+            self.watermark = await self._load_watermark()
+        since = datetime.combine(self.watermark.date(), time.min)
+        query = {"status": "active", "expiry_date": {"$gte": since}}
+        if not date_migration_done:
+            # Unconverted records still hold fmt() strings, which sort after datetimes
+            query = {"status": "active", "$or": [
+                {"expiry_date": {"$gte": since}},
+                {"expiry_date": {"$type": "string", "$gte": fmt(since)}},
+            ]}
+        heap = []
+        self.heap, self.cancelled = heap, set()
+        async for doc in store.iterate("purchases", query, PROJECTIONS["expiry_schedule"], batch_size=1000):
+            expiry = as_datetime(doc.get("expiry_date"))
+            if expiry is not None:
+                self._push(doc["_id"], expiry, self.watermark)
+        self.arm()
+        print(f"⏰ Expiry scheduler: {len(self.heap)} reminders pending")
+
+    def arm(self):
+        """Point the single timer at the earliest pending reminder"""
+        if not self.active or not self.heap:
+            return
+        fire_at = self.heap[0][0]
+        if self.job is not None and not self.job.removed and self.armed_at is not None and self.armed_at <= fire_at:
+            return
+        if self.job is not None:
+            self.job.schedule_removal()
+        delay = max((fire_at - datetime.now()).total_seconds(), 0)
+        self.job = self.app.job_queue.run_once(
+            instrumented(self._on_timer, "job"), when=delay, name="expiry_reminders"
+        )
+        self.armed_at = fire_at
+
+    async def _on_timer(self, context: ContextTypes.DEFAULT_TYPE):
+        self.job = None
+        self.armed_at = None
+        try:
+            await self.fire_due(context.bot)
+        finally:
+            self.arm()
+
+    def pop_due(self, now: datetime) -> dict:
+        """Pending reminders up to now, one per record (the closest lead wins)"""
+        due: dict[ObjectId, datetime] = {}
+        while self.heap and self.heap[0][0] <= now:
+            _, _, oid, expiry = heapq.heappop(self.heap)
+            if oid not in self.cancelled:
+                due[oid] = expiry
+        return due
+
+    async def fire_due(self, bot, now: datetime | None = None) -> int:
+        """Send every reminder that is due; returns the number of records notified"""
+        async with self._lock:
+            return await self._fire_due(bot, now or datetime.now())
+
+    async def _fire_due(self, bot, now: datetime) -> int:
+        due = self.pop_due(now)
+        if not due:
+            return 0
+        if not db_available:
+            # Put them back and retry in a few minutes
+            for oid, expiry in due.items():
+                self.seq += 1
+                heapq.heappush(self.heap, (now + timedelta(minutes=5), self.seq, oid, expiry))
+            return 0
         
-        admin_expiries = {}
-        super_admin_summary = []
-        
-        for apk in expiring_apks:
-            owner_id = apk.get("owner_id", SUPER_ADMIN_ID)
-            
-            if owner_id not in admin_expiries:
-                admin_expiries[owner_id] = []
-            
-            admin_expiries[owner_id].append({
-                "client_name": apk.get("client_name", "-"),
-                "apk_name": apk.get("apk_name", "-"),
-                "expiry_date": apk.get("expiry_date", "-")
-            })
-            
-            super_admin_summary.append(f"• {apk.get('client_name', '-')} - {apk.get('apk_name', '-')} (Owner: {owner_id})")
-        
-        for owner_id, apks in admin_expiries.items():
-            is_registered = await is_user_registered(owner_id)
-            if is_registered:
-                message_lines = ["🔔 आपके clients के APKs आज expire हो रहे हैं:", ""]
-                
-                for apk in apks:
-                    message_lines.append(f"👤 Client: {apk['client_name']}")
-                    message_lines.append(f"📦 APK: {apk['apk_name']}")
-                    message_lines.append(f"⏰ Expiry: {apk['expiry_date']}")
-                    message_lines.append("")
-                
-                message_lines.append("कृपया जल्दी renewal करें! 🚨")
+        today = now.date()
+        report = new_dispatch_report()
+        summary = ReportWriter(
+            chat_sender(bot, SUPER_ADMIN_ID, report),
+            [f"📊 EXPIRY REMINDERS - {today.strftime('%d/%m/%Y')}", ""],
+        )
+        writers = {}  # owner_id -> ReportWriter, None for unregistered owners
+        notified = 0
+        oids = list(due)
+        for i in range(0, len(oids), 1000):
+            records = await store.find(
+                "purchases", {"_id": {"$in": oids[i:i + 1000]}, "status": "active"}, PROJECTIONS["expiry_schedule"]
+            )
+            for record in records:
+                expiry = as_datetime(record.get("expiry_date"))
+                if expiry is None or expiry.date() != due[record["_id"]].date():
+                    continue  # expiry changed since it was scheduled
+                days_left = (expiry.date() - today).days
+                if days_left == 0:
+                    when = "आज expire हो रहा है"
+                elif days_left > 0:
+                    when = f"{days_left} दिन में expire होगा"
+                else:
+                    when = f"{-days_left} दिन पहले expire हो गया"
+                owner_id = record.get("owner_id") or SUPER_ADMIN_ID
+                client_name = record.get("client_name", "-")
+                apk_name = record.get("apk_name", "-")
+                await summary.write(f"• {client_name} - {apk_name} (Owner: {owner_id}) — {when}")
                 
-                await send_notification(context, owner_id, "\n".join(message_lines))
+                if owner_id not in writers:
+                    writers[owner_id] = await owner_writer(
+                        bot, owner_id, ["🔔 आपके clients के APK expiry reminders:", ""], report
+                    )
+                writer = writers[owner_id]
+                if writer:
+                    await writer.write(
+                        f"👤 Client: {client_name}",
+                        f"📦 APK: {apk_name}",
+                        f"⏰ Expiry: {fmt_stored(record.get('expiry_date'))} ({when})",
+                        "",
+                    )
+                notified += 1
         
-        if super_admin_summary:
-            super_message = f"📊 DAILY EXPIRY REPORT - {today.strftime('%d/%m/%Y')}\n\n"
-            super_message += f"कुल {len(expiring_apks)} APKs आज expire हो रहे हैं:\n\n"
-            super_message += "\n".join(super_admin_summary)
-            super_message += f"\n\n🔔 सभी संबंधित admins को notification भेज दी गई है।"
-            
-            await send_notification(context, SUPER_ADMIN_ID, super_message)
+        owners = [writer for writer in writers.values() if writer]
+        await asyncio.gather(*(writer.close("कृपया जल्दी renewal करें! 🚨") for writer in owners))
+        if notified:
+            await summary.close("", "🔔 सभी संबंधित admins को notification भेज दी गई है।")
+        await self._save_watermark(now)
+        self.cancelled.intersection_update(oid for _, _, oid, _ in self.heap)
+        self.fired += notified
+        print(f"📨 Expiry reminders for {notified} records: {report}")
         
         await log_activity("expiry_check", SUPER_ADMIN_ID, {
-            "total_expiring": len(expiring_apks),
-            "owners_notified": len(admin_expiries)
+            "total_expiring": notified,
+            "owners_notified": len(owners),
+            "notifications": report
         })
-        
-    except Exception as e:
-        print(f"⚠ Expiry check error: {e}")
-        await send_notification(context, SUPER_ADMIN_ID, f"⚠ Expiry check में error आई: {str(e)}")
+        return notified
+
+    def stats(self) -> dict:
+        return {
+            "pending": len(self.heap),
+            "next": fmt(self.heap[0][0]) if self.heap else "-",
+            "fired": self.fired,
+        }
+
+expiry_scheduler = ExpiryScheduler(EXPIRY_REMINDER_DAYS, EXPIRY_NOTIFY_HOUR)
 
 def build_confirm_kb():
     return InlineKeyboardMarkup([
@@ -335,10 +1429,54 @@ def can_access_data(user_id: int, record_owner_id: int) -> bool:
         return True
     return user_id == record_owner_id
 
+# ---- Inactivity Sweeper ----
+INACTIVITY_TIMEOUT = int(os.getenv("INACTIVITY_TIMEOUT", "3600"))  # seconds
+SWEEP_INTERVAL = int(os.getenv("SWEEP_INTERVAL", "60"))  # seconds
+
+class InactivityIndex:
+    """Min-heap of (deadline, user_id) so the sweeper only visits expired sessions.
+
+    Each user has at most one heap entry; touching only moves the deadline in
+    a dict, and an entry popped early is pushed back with its newer deadline.
+    """
+
+    def __init__(self, timeout: int):
+        self.timeout = timedelta(seconds=timeout)
+        self.heap: list[tuple[datetime, int]] = []
+        self.deadlines: dict[int, datetime] = {}
+
+    def touch(self, user_id: int, last_activity: datetime):
+        deadline = last_activity + self.timeout
+        if user_id not in self.deadlines:
+            heapq.heappush(self.heap, (deadline, user_id))
+        self.deadlines[user_id] = deadline
+
+    def forget(self, user_id: int):
+        self.deadlines.pop(user_id, None)
+
+    def pop_expired(self, now: datetime) -> list[int]:
+        expired = []
+        while self.heap and self.heap[0][0] <= now:
+            _, user_id = heapq.heappop(self.heap)
+            deadline = self.deadlines.get(user_id)
+            if deadline is None:
+                continue  # forgotten
+            if deadline > now:
+                heapq.heappush(self.heap, (deadline, user_id))
+            else:
+                del self.deadlines[user_id]
+                expired.append(user_id)
+        return expired
+
+inactivity_index = InactivityIndex(INACTIVITY_TIMEOUT)
+
 def update_last_activity(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Update last activity timestamp for the user"""
     if update.effective_chat:
-        context.user_data["last_activity"] = datetime.now()
+        now = datetime.now()
+        context.user_data["last_activity"] = now
+        if update.effective_user:
+            inactivity_index.touch(update.effective_user.id, now)
 
 # Modified wrong message handler with activity tracking
 async def catch_wrong_msg(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -356,7 +1494,7 @@ async def catch_wrong_msg(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not update.message:
         return
     text = (update.message.text or "").strip()
-    if any(text.startswith(cmd) for cmd in ["/Start", "/History", "/Deletehistory", "/Duecheck", "/Ownerid", "/Addid", "/Removeid"]):
+    if any(text.startswith(cmd) for cmd in ["/Start", "/History", "/Deletehistory", "/Duecheck", "/Export", "/Ownerid", "/Addid", "/Removeid"]):
         return
     cnt = context.user_data.get("wrong_count", 0)
     if cnt >= 3:
@@ -370,8 +1508,336 @@ async def catch_wrong_msg(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         await update.message.reply_text("🤖sale🤖 tu 🚫BLOCK🚫 hoke hi manega")
 
+# ---- Callback Tokens ----
+CALLBACK_TOKEN_CACHE = int(os.getenv("CALLBACK_TOKEN_CACHE", "5000"))  # payloads kept in memory
+CALLBACK_TOKEN_TTL = int(os.getenv("CALLBACK_TOKEN_TTL", str(7 * 24 * 3600)))  # seconds a button keeps working
+CALLBACK_TOKEN_FIELDS = {
+    # legacy "action|..." layouts, so buttons sent before tokens keep working
+    "deln": ("idx", "oid", "client"),
+    "partial": ("idx", "oid", "client"),
+    "fullpay": ("idx", "oid", "client"),
+    "pass": ("idx", "oid", "client"),
+    "hpage": ("page", "flag", "client"),
+    "history": ("client",),
+}
+
+class CallbackTokenRegistry:
+    """Maps short opaque tokens to button payloads (action, record id, client, owner...).
+
+    Button data is just "action:token", well inside Telegram's 64 bytes
+    whatever the client name. Identical payloads reuse their token, the
+    newest CALLBACK_TOKEN_CACHE stay in memory (LRU) and every token is
+    saved to the callback_tokens collection (TTL index), so a tap still
+    resolves after a restart or once the token has left the LRU.
+    """
+
+    def __init__(self, max_size: int, ttl: int):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.items: OrderedDict[str, dict] = OrderedDict()  # token -> payload
+        self.by_payload: dict[tuple, tuple[str, float]] = {}  # payload -> (token, issued at)
+        self.pending: dict[str, dict] = {}  # issued but not saved yet
+        self.hits = 0
+        self.loads = 0
+        self.misses = 0
+
+    def _remember(self, token: str, payload: dict, issued: float):
+        self.items[token] = payload
+        self.items.move_to_end(token)
+        self.by_payload[tuple(sorted(payload.items()))] = (token, issued)
+        while len(self.items) > self.max_size:
+            old_token, old_payload = self.items.popitem(last=False)
+            key = tuple(sorted(old_payload.items()))
+            if self.by_payload.get(key, ("",))[0] == old_token:
+                del self.by_payload[key]
+
+    def issue(self, action: str, **fields) -> str:
+        """callback_data for a button; call save() before sending the markup"""
+        payload = {"action": action, **{k: v for k, v in fields.items() if v is not None}}
+        token, issued = self.by_payload.get(tuple(sorted(payload.items())), (None, 0))
+        # Reuse only while the saved copy is far from its TTL
+        if token is None or monotonic() - issued > self.ttl / 2:
+            token, issued = secrets.token_urlsafe(6), monotonic()
+            while token in self.items:
+                token = secrets.token_urlsafe(6)
+            self.pending[token] = payload
+            if len(self.pending) > self.max_size:
+                self.pending.pop(next(iter(self.pending)))
+        self._remember(token, payload, issued)
+        return f"{action}:{token}"
+
+    async def save(self):
+        """Persist newly issued tokens; on failure they still work on this worker"""
+        if not self.pending or not db_available or store is None:
+            return
+        pending, self.pending = self.pending, {}
+        now = datetime.now()
+        try:
+            await store.bulk_write("callback_tokens", [
+                ReplaceOne({"_id": token}, {"data": payload, "created_at": now}, upsert=True)
+                for token, payload in pending.items()
+            ])
+        except Exception as e:
+            print(f"⚠ Callback token save error: {e}")
+            self.pending.update(pending)
+
+    async def resolve(self, data: str) -> dict | None:
+        """Payload for a button's callback_data, None once it has expired"""
+        action, sep, token = data.partition(":")
+        if not sep:
+            return self._parse_legacy(data)
+        payload = self.items.get(token)
+        if payload is not None:
+            self.items.move_to_end(token)
+            self.hits += 1
+            return payload
+        if db_available and store is not None:
+            try:
+                doc = await store.find_one("callback_tokens", {"_id": token}, PROJECTIONS["callback_token"])
+            except Exception as e:
+                print(f"⚠ Callback token lookup error: {e}")
+                doc = None
+            if doc and doc.get("data", {}).get("action") == action:
+                self.loads += 1
+                # Age it from when it was saved so issue() stops reusing it
+                # in time; without created_at it is never reused
+                saved = doc.get("created_at")
+                age = (datetime.now() - saved).total_seconds() if isinstance(saved, datetime) else self.ttl
+                self._remember(token, doc["data"], monotonic() - age)
+                return doc["data"]
+        self.misses += 1
+        return None
+
+    def _parse_legacy(self, data: str) -> dict | None:
+        action, _, rest = data.partition("|")
+        fields = CALLBACK_TOKEN_FIELDS.get(action)
+        if fields is None:
+            return None
+        values = rest.split("|", len(fields) - 1)
+        if len(values) != len(fields):
+            return None
+        payload = {"action": action, **dict(zip(fields, values))}
+        # Legacy data comes straight from the client, so check every field
+        if "oid" in payload and not ObjectId.is_valid(payload["oid"]):
+            return None
+        if "idx" in payload and not payload["idx"].isdigit():
+            return None
+        if "flag" in payload and payload["flag"] not in ("a", "d"):
+            return None
+        if "page" in payload:
+            if not payload["page"].isdigit():
+                return None
+            payload["page"] = int(payload["page"])
+        return payload
+
+    def stats(self) -> dict:
+        return {"size": len(self.items), "hits": self.hits, "loads": self.loads, "misses": self.misses}
+
+callback_tokens = CallbackTokenRegistry(CALLBACK_TOKEN_CACHE, CALLBACK_TOKEN_TTL)
+
+async def callback_payload(update: Update) -> dict | None:
+    """Resolve the tapped button; tells the user when it has expired or is invalid"""
+    query = update.callback_query
+    payload = await callback_tokens.resolve(query.data or "")
+    if payload is None:
+        await query.message.reply_text("⌛ यह button पुराना या invalid है, /History फिर से चलाएं।")
+    return payload
+
+async def payload_owner(payload: dict) -> int | None:
+    """Record owner for a button: from the token, or read for legacy buttons"""
+    if "owner" in payload:
+        return payload["owner"]
+    if not db_available:
+        return None
+    try:
+        record = await store.find_one("purchases", {"_id": ObjectId(payload["oid"])}, PROJECTIONS["owner_check"])
+    except Exception:
+        return None
+    return record.get("owner_id", SUPER_ADMIN_ID) if record else None
+
+# ---- Client Directory ----
+CLIENT_DIRECTORY_TTL = int(os.getenv("CLIENT_DIRECTORY_TTL", "300"))  # seconds before reloading from DB
+CLIENT_SUGGESTIONS = 8  # matches offered when a name isn't found
+CLIENT_PREFIX_SCAN = 500  # keys walked per prefix lookup at most
+
+class ClientDirectory:
+    """In-memory index of client names for prefix and typo-tolerant lookups.
+
+    Normalized names sit in a sorted list, so a prefix query is a bisect plus
+    a short walk. A one-deletion neighbourhood map (SymSpell style) finds names
+    within a single typo without scanning. Backed by the clients collection
+    and reloaded every CLIENT_DIRECTORY_TTL seconds to pick up other workers.
+    """
+
+    def __init__(self, ttl: int):
+        self.ttl = ttl
+        self.keys: list[str] = []
+        self.entries: dict[str, dict] = {}  # client_key -> {"name", "owners"}
+        self.deletes: dict[str, set[str]] = {}  # one-deletion variant -> client_keys
+        self.loaded_at: float | None = None
+        self._refresh_task = None
+
+    @staticmethod
+    def _variants(key: str) -> set[str]:
+        return {key} | {key[:i] + key[i + 1:] for i in range(len(key))}
+
+    def _index(self, key: str, name: str, owners):
+        entry = self.entries.get(key)
+        if entry is None:
+            insort(self.keys, key)
+            for variant in self._variants(key):
+                self.deletes.setdefault(variant, set()).add(key)
+            self.entries[key] = {"name": name, "owners": set(owners)}
+        else:
+            entry["name"] = name
+            entry["owners"].update(owners)
+
+    async def load(self):
+        """Rebuild the index from the clients collection"""
+        docs = await store.find("clients", {}, PROJECTIONS["client_directory"], timeout=30)
+        fresh = ClientDirectory(self.ttl)
+        for doc in docs:
+            fresh._index(doc["_id"], doc.get("name") or doc["_id"], doc.get("owners") or [])
+        self.keys, self.entries, self.deletes = fresh.keys, fresh.entries, fresh.deletes
+        self.loaded_at = monotonic()
+
+    async def _safe_load(self):
+        try:
+            await self.load()
+        except Exception as e:
+            print(f"⚠ Client directory reload error: {e}")
+
+    async def add(self, client_name: str, owner_id: int):
+        """Record a client after a purchase is saved (DB upsert + local index)"""
+        key = normalize_client_name(client_name)
+        self._index(key, client_name, [owner_id])
+        await store.update_one(
+            "clients", {"_id": key},
+            {"$set": {"name": client_name, "updated_at": datetime.now()}, "$addToSet": {"owners": owner_id}},
+            upsert=True,
+        )
+
+    @property
+    def ready(self) -> bool:
+        return self.loaded_at is not None
+
+    def _visible(self, key: str, user_id: int) -> bool:
+        return user_id == SUPER_ADMIN_ID or user_id in self.entries[key]["owners"]
+
+    def contains(self, client_name: str, user_id: int) -> bool:
+        key = normalize_client_name(client_name)
+        return key in self.entries and self._visible(key, user_id)
+
+    def search(self, text: str, user_id: int, limit: int = CLIENT_SUGGESTIONS) -> list[str]:
+        """Display names starting with text, then names one typo away"""
+        if self.loaded_at is not None and monotonic() - self.loaded_at > self.ttl:
+            if self._refresh_task is None or self._refresh_task.done():
+                self._refresh_task = spawn_background(self._safe_load())
+        key = normalize_client_name(text)
+        if not key:
+            return []
+        found = []
+        i = bisect_left(self.keys, key)
+        end = min(len(self.keys), i + CLIENT_PREFIX_SCAN)
+        while i < end and len(found) < limit and self.keys[i].startswith(key):
+            if self._visible(self.keys[i], user_id):
+                found.append(self.keys[i])
+            i += 1
+        if len(found) < limit and len(key) >= 3:
+            close = set()
+            for variant in self._variants(key):
+                close |= self.deletes.get(variant, set())
+            for match in sorted(close.difference(found)):
+                if len(found) >= limit:
+                    break
+                if self._visible(match, user_id):
+                    found.append(match)
+        return [self.entries[k]["name"] for k in found]
+
+client_directory = ClientDirectory(CLIENT_DIRECTORY_TTL)
+
+async def offer_client_matches(client_name: str, update: Update, include_deleted: bool) -> bool:
+    """If the name isn't an exact client, reply with clickable close matches.
+
+    Returns True when suggestions were sent; False means carry on with the
+    normal lookup (exact match, no matches, or directory not loaded yet).
+    """
+    user_id = update.effective_user.id if update.effective_user else None
+    if not client_directory.ready or client_directory.contains(client_name, user_id):
+        return False
+    matches = client_directory.search(client_name, user_id)
+    flag = "d" if include_deleted else "a"
+    buttons = [
+        [InlineKeyboardButton(f"👤 {name}", callback_data=callback_tokens.issue("hpage", page=0, flag=flag, client=name))]
+        for name in matches
+    ]
+    if not buttons:
+        return False
+    await callback_tokens.save()
+    await update.message.reply_text(f"🔍 '{client_name}' नाम का client नहीं मिला। क्या आपका मतलब:", reply_markup=InlineKeyboardMarkup(buttons))
+    return True
+
 # ---- History Functions ----
-async def show_history(client_name: str, update: Update, context: ContextTypes.DEFAULT_TYPE, include_deleted=False, is_super_command=False):
+HISTORY_PAGE_SIZE = int(os.getenv("HISTORY_PAGE_SIZE", "5"))
+
+def render_purchase_text(i: int, p: dict, user_id: int, now: datetime) -> str:
+    """One purchase record as shown in the history view"""
+    expiry_dt = as_datetime(p.get("expiry_date")) or now
+    status_field = p.get("status", "active")
+    due_amount = p.get("due_amount", 0)
+    
+    if status_field == "deleted":
+        status = "❌ Deleted"
+    elif expiry_dt < now:
+        status = "⌛ Expired"
+    elif due_amount == 0:
+        status = "✅ Paid"
+    else:
+        status = "💰 Due"
+
+    total_price = p.get("total_price", 0)
+    payments = p.get("payments", [])
+    owner_id = p.get("owner_id", "Unknown")
+    
+    text = (
+        f"{i}.\n"
+        f"📦 APK: {p.get('apk_name','-')}\n"
+        f"🗓 Purchase: {fmt_stored(p.get('purchase_date'))}\n"
+        f"⏳ Expiry: {fmt_stored(p.get('expiry_date'))}\n"
+        f"💵 Total Price: ₹{total_price}\n"
+        f"💰 Due: ₹{due_amount}\n"
+        f"📌 Status: {status}"
+    )
+    
+    if payments:
+        text += "\n💳 Payment History:"
+        if len(payments) > HISTORY_MAX_PAYMENTS:
+            text += "\n  … earlier payments"
+        for payment in payments[-HISTORY_MAX_PAYMENTS:]:
+            text += f"\n  • ₹{payment.get('amount', 0)} on {payment.get('date', '-')}"
+    
+    if user_id == SUPER_ADMIN_ID:
+        text += f"\n👤 Owner: {owner_id}"
+    return text
+
+def build_purchase_buttons(i: int, p: dict, user_id: int, client_name: str) -> list:
+    """Action buttons (one row) for a record the user may modify"""
+    row = []
+    record_owner_id = p.get("owner_id", SUPER_ADMIN_ID)
+    due_amount = p.get("due_amount", 0)
+    if p.get("status", "active") == "active" and can_access_data(user_id, record_owner_id):
+        fields = {"idx": i, "oid": str(p["_id"]), "client": client_name, "owner": record_owner_id}
+        row.append(InlineKeyboardButton(f"❌ Delete #{i}", callback_data=callback_tokens.issue("deln", **fields)))
+        
+        if user_id == SUPER_ADMIN_ID and due_amount > 0:
+            row.append(InlineKeyboardButton(f"💳 Partial #{i}", callback_data=callback_tokens.issue("partial", **fields)))
+        
+        if due_amount > 0:
+            row.append(InlineKeyboardButton(f"💵 Full Paid #{i}", callback_data=callback_tokens.issue("fullpay", **fields)))
+    return row
+
+async def show_history(client_name: str, update: Update, context: ContextTypes.DEFAULT_TYPE, include_deleted=False, is_super_command=False, page: int | None = None):
+    """Single-message, paginated purchase history (HISTORY_PAGE_SIZE records per page)"""
     msg = _msg_from_update(update)
     if not msg:
         return
@@ -380,122 +1846,222 @@ async def show_history(client_name: str, update: Update, context: ContextTypes.D
         return
 
     user_id = update.effective_user.id if update.effective_user else None
+    client_key = normalize_client_name(client_name)
+    
+    # Refreshes (after payment/delete) stay on the page the user was looking at
+    view = context.user_data.get("history_view")
+    if page is None:
+        same_view = view and view.get("client_key") == client_key and view.get("include_deleted") == include_deleted
+        page = view.get("page", 0) if same_view else 0
+    
+    query = {"client_key": client_key}
+    if not include_deleted:
+        query["status"] = {"$ne": "deleted"}
+    if not is_super_command and user_id != SUPER_ADMIN_ID:
+        query["owner_id"] = user_id
     
     try:
-        purchases = await asyncio.to_thread(lambda: list(
-            collection.find({"client_name": {"$regex": f"^{re.escape(client_name)}$", "$options": "i"}}).sort([("purchase_date", 1), ("_id", 1)])
-        ))
+        while True:
+            purchases = await store.find(
+                "purchases", query, PROJECTIONS["history"],
+                sort=[("purchase_date", 1), ("_id", 1)],
+                skip=page * HISTORY_PAGE_SIZE,
+                limit=HISTORY_PAGE_SIZE + 1,
+            )
+            if purchases or page == 0:
+                break
+            page -= 1  # page emptied by a delete, step back
+        
+        if not purchases and "owner_id" in query:
+            query.pop("owner_id")
+            if await store.find_one("purchases", query, PROJECTIONS["exists"]):
+                await msg.reply_text("❌ आपको इस user का data access करने की permission नहीं है।")
+                return
     except:
         await msg.reply_text("⚠ DB fetch error")
         return
 
-    if not include_deleted:
-        purchases = [p for p in purchases if p.get("status","active") != "deleted"]
-
     if not purchases:
         await msg.reply_text("Esse pahle en naam se kisi ne koi bhi item nahi kharida hai")
         return
 
-    if not is_super_command and user_id != SUPER_ADMIN_ID:
-        accessible_purchases = []
-        for p in purchases:
-            record_owner_id = p.get("owner_id", SUPER_ADMIN_ID)
-            if can_access_data(user_id, record_owner_id):
-                accessible_purchases.append(p)
-        purchases = accessible_purchases
-        
-        if not purchases:
-            await msg.reply_text("❌ आपको इस user का data access करने की permission नहीं है।")
-            return
-
-    if "history_msgs" not in context.user_data:
-        context.user_data["history_msgs"] = []
-
+    has_next = len(purchases) > HISTORY_PAGE_SIZE
+    purchases = purchases[:HISTORY_PAGE_SIZE]
     now = datetime.now()
-
-    header_text = f"📜 History for {client_name}:"
-    if context.user_data["history_msgs"]:
+    first = page * HISTORY_PAGE_SIZE + 1
+
+    blocks = [f"📜 History for {client_name} (Page {page + 1}):"]
+    keyboard = []
+    for i, p in enumerate(purchases, start=first):
+        blocks.append(render_purchase_text(i, p, user_id, now))
+        row = build_purchase_buttons(i, p, user_id, client_name)
+        if row:
+            keyboard.append(row)
+    
+    flag = "d" if include_deleted else "a"
+    nav = []
+    if page > 0:
+        nav.append(InlineKeyboardButton("⬅ Prev", callback_data=callback_tokens.issue("hpage", page=page - 1, flag=flag, client=client_name)))
+    if has_next:
+        nav.append(InlineKeyboardButton("Next ➡", callback_data=callback_tokens.issue("hpage", page=page + 1, flag=flag, client=client_name)))
+    if nav:
+        keyboard.append(nav)
+    await callback_tokens.save()
+    
+    text = "\n\n".join(blocks)[:4096]
+    markup = InlineKeyboardMarkup(keyboard) if keyboard else None
+    context.user_data["history_view"] = {"client_key": client_key, "page": page, "include_deleted": include_deleted}
+
+    history_msgs = context.user_data.get("history_msgs") or []
+    if history_msgs:
         try:
-            await msg.bot.edit_message_text(chat_id=msg.chat_id, message_id=context.user_data["history_msgs"][0], text=header_text)
-        except:
-            h = await msg.reply_text(header_text)
-            context.user_data["history_msgs"][0] = h.message_id
-    else:
-        h = await msg.reply_text(header_text)
-        context.user_data["history_msgs"].append(h.message_id)
-
-    for i, p in enumerate(purchases, start=1):
-        try:
-            expiry_dt = datetime.strptime(p.get("expiry_date", ""), "%Y-%m-%d %H:%M:%S")
+            await msg.bot.edit_message_text(chat_id=msg.chat_id, message_id=history_msgs[0], text=text, reply_markup=markup)
+            return
         except:
-            expiry_dt = now
-        
-        status_field = p.get("status", "active")
-        due_amount = p.get("due_amount", 0)
-        
-        if status_field == "deleted":
-            status = "❌ Deleted"
-        elif expiry_dt < now:
-            status = "⌛ Expired"
-        elif due_amount == 0:
-            status = "✅ Paid"
-        else:
-            status = "💰 Due"
-
-        total_price = p.get("total_price", 0)
-        payments = p.get("payments", [])
-        owner_id = p.get("owner_id", "Unknown")
-        
-        text = (
-            f"{i}.\n"
-            f"📦 APK: {p.get('apk_name','-')}\n"
-            f"🗓 Purchase: {p.get('purchase_date','-')}\n"
-            f"⏳ Expiry: {p.get('expiry_date','-')}\n"
-            f"💵 Total Price: ₹{total_price}\n"
-            f"💰 Due: ₹{due_amount}\n"
-            f"📌 Status: {status}"
-        )
-        
-        if payments:
-            text += "\n\n💳 Payment History:"
-            for payment in payments:
-                text += f"\n  • ₹{payment.get('amount', 0)} on {payment.get('date', '-')}"
-        
-        if user_id == SUPER_ADMIN_ID:
-            text += f"\n👤 Owner: {owner_id}"
-
-        keyboard = []
-        record_owner_id = p.get("owner_id", SUPER_ADMIN_ID)
+            pass
+    m = await msg.reply_text(text, reply_markup=markup)
+    context.user_data["history_msgs"] = [m.message_id]
+
+# ---- Inline Client Lookup ----
+INLINE_RESULTS = 10  # clients per inline answer
+INLINE_RECORDS = 3  # latest active records rendered per client
+INLINE_CACHE_TTL = int(os.getenv("INLINE_CACHE_TTL", "30"))  # seconds, server side
+INLINE_CACHE_SIZE = 500
+INLINE_CACHE_TIME = int(os.getenv("INLINE_CACHE_TIME", "30"))  # seconds, Telegram side
+
+class InlineResultCache:
+    """Small LRU/TTL cache of built inline answers keyed by (viewer, query).
+
+    Repeated keystrokes and other admins typing the same thing are answered
+    without touching Mongo; any due change (ledger_apply) clears it.
+    """
+
+    def __init__(self, max_size: int, ttl: int):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.items: OrderedDict[tuple, tuple[float, list]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: tuple) -> list | None:
+        entry = self.items.get(key)
+        if entry is None or monotonic() - entry[0] > self.ttl:
+            if entry is not None:
+                del self.items[key]
+            self.misses += 1
+            return None
+        self.items.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key: tuple, results: list):
+        self.items[key] = (monotonic(), results)
+        self.items.move_to_end(key)
+        while len(self.items) > self.max_size:
+            self.items.popitem(last=False)
+
+    def clear(self):
+        self.items.clear()
+
+    def stats(self) -> dict:
+        return {"size": len(self.items), "hits": self.hits, "misses": self.misses}
+
+inline_cache = InlineResultCache(INLINE_CACHE_SIZE, INLINE_CACHE_TTL)
+
+async def fetch_client_summaries(client_keys: list[str], user_id: int) -> dict:
+    """Dues and latest active records for several clients in one aggregation"""
+    match = {"client_key": {"$in": client_keys}, "status": "active"}
+    if user_id != SUPER_ADMIN_ID:
+        match["owner_id"] = user_id
+    pipeline = [
+        {"$match": match},
+        {"$sort": {"purchase_date": -1}},
+        {"$group": {
+            "_id": "$client_key",
+            "total_due": {"$sum": "$due_amount"},
+            "open": {"$sum": {"$cond": [{"$gt": ["$due_amount", 0]}, 1, 0]}},
+            "records": {"$push": {
+                "apk_name": "$apk_name", "purchase_date": "$purchase_date", "expiry_date": "$expiry_date",
+                "total_price": "$total_price", "due_amount": "$due_amount", "status": "$status",
+                "owner_id": "$owner_id",
+            }},
+        }},
+        {"$project": {"total_due": 1, "open": 1, "records": {"$slice": ["$records", INLINE_RECORDS]}}},
+    ]
+    return {doc["_id"]: doc for doc in await store.aggregate("purchases", pipeline)}
 
-        if status_field == "active" and can_access_data(user_id, record_owner_id):
-            keyboard.append([InlineKeyboardButton(f"❌ Delete", callback_data=f"deln|{i}|{str(p['_id'])}|{client_name}")])
-            
-            if user_id == SUPER_ADMIN_ID and due_amount > 0:
-                keyboard.append([InlineKeyboardButton(f"💳 Partial Payment", callback_data=f"partial|{i}|{str(p['_id'])}|{client_name}")])
-            
-            if due_amount > 0:
-                keyboard.append([InlineKeyboardButton(f"💵 Mark Full Paid", callback_data=f"fullpay|{i}|{str(p['_id'])}|{client_name}")])
+async def build_inline_results(text: str, user_id: int) -> list:
+    names = client_directory.search(text, user_id, limit=INLINE_RESULTS)
+    if not names:
+        return []
+    summaries = await fetch_client_summaries([normalize_client_name(n) for n in names], user_id)
+    now = datetime.now()
+    results = []
+    for name in names:
+        key = normalize_client_name(name)
+        summary = summaries.get(key)
+        if not summary:
+            continue  # nothing active this viewer may see
+        total_due = round(summary["total_due"], 2)
+        blocks = [f"📜 {name} — Due: ₹{total_due}"]
+        blocks += [render_purchase_text(i, p, user_id, now) for i, p in enumerate(summary["records"], start=1)]
+        results.append(InlineQueryResultArticle(
+            id=key.encode()[:64].decode(errors="ignore") or "client",
+            title=f"👤 {name}",
+            description=f"💰 Due ₹{total_due} | {summary['open']} open | latest: {summary['records'][0].get('apk_name', '-')}",
+            input_message_content=InputTextMessageContent("\n\n".join(blocks)[:4096]),
+        ))
+    return results
 
-        if i < len(context.user_data["history_msgs"]):
-            try:
-                await msg.bot.edit_message_text(
-                    chat_id=msg.chat_id,
-                    message_id=context.user_data["history_msgs"][i],
-                    text=text,
-                    reply_markup=InlineKeyboardMarkup(keyboard) if keyboard else None
-                )
-            except:
-                m = await msg.reply_text(text, reply_markup=InlineKeyboardMarkup(keyboard) if keyboard else None)
-                context.user_data["history_msgs"][i] = m.message_id
-        else:
-            m = await msg.reply_text(text, reply_markup=InlineKeyboardMarkup(keyboard) if keyboard else None)
-            context.user_data["history_msgs"].append(m.message_id)
+async def inline_query_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """@bot <name>: matching clients with their dues, answered from cache when possible"""
+    inline_query = update.inline_query
+    user_id = inline_query.from_user.id
+    text = (inline_query.query or "").strip()
+    
+    if not text or not await is_user_registered(user_id) or not db_available or not client_directory.ready:
+        await inline_query.answer([], cache_time=5, is_personal=True)
+        return
+    
+    cache_key = ("super" if user_id == SUPER_ADMIN_ID else user_id, normalize_client_name(text))
+    results = inline_cache.get(cache_key)
+    if results is None:
+        try:
+            results = await build_inline_results(text, user_id)
+        except Exception as e:
+            print(f"⚠ Inline query error: {e}")
+            await inline_query.answer([], cache_time=5, is_personal=True)
+            return
+        inline_cache.put(cache_key, results)
+    await inline_query.answer(results, cache_time=INLINE_CACHE_TIME, is_personal=True)
 
 # ---- Partial Payment System ----
+def payment_update(amount: float | None) -> list:
+    """Update pipeline that records a payment in one round trip.
+
+    amount=None settles the whole remaining due. The pipeline form (rather than
+    $inc/$push) lets the server decide the paid amount and partial/final type
+    from the current due inside the same atomic write.
+    """
+    paid = "$due_amount" if amount is None else amount
+    return [{"$set": {
+        "payments": {"$concatArrays": [
+            {"$ifNull": ["$payments", []]},
+            [{
+                "amount": paid,
+                "date": {"$literal": fmt(datetime.now())},
+                "type": {"$cond": [{"$gt": ["$due_amount", paid]}, "partial", "final"]},
+            }],
+        ]},
+        "due_amount": {"$subtract": ["$due_amount", paid]},
+    }}]
 async def partial_payment_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    _, idx, obj_id_str, client_name = query.data.split("|")
+    payload = await callback_payload(update)
+    if not payload:
+        return ConversationHandler.END
+    obj_id_str, client_name = payload["oid"], payload["client"]
     user_id = query.from_user.id
     
     if user_id != SUPER_ADMIN_ID:
@@ -514,6 +2080,8 @@ async def handle_partial_amount(update: Update, context: ContextTypes.DEFAULT_TY
     try:
         amount = float(entered)
     except ValueError:
+        amount = 0
+    if amount <= 0:
         await update.message.reply_text("❌ Invalid amount. केवल numbers enter करें।")
         return ASK_PARTIAL_AMOUNT
 
@@ -524,33 +2092,25 @@ async def handle_partial_amount(update: Update, context: ContextTypes.DEFAULT_TY
 
     if db_available and obj_id_str:
         try:
-            record = await asyncio.to_thread(collection.find_one, {"_id": ObjectId(obj_id_str)})
+            # Guarded atomic update: due never goes below 0, concurrent payments can't overwrite each other
+            record = await ledger_write(
+                store.find_one_and_update(
+                    "purchases",
+                    {"_id": ObjectId(obj_id_str), "status": "active", "due_amount": {"$gte": amount}},
+                    payment_update(amount),
+                    projection=PROJECTIONS["payment_result"],
+                ),
+                lambda r: r and (r.get("owner_id"), -amount, -1 if r.get("due_amount", 0) <= 0 else 0),
+            )
             if not record:
-                await update.message.reply_text("❌ Record not found.")
-                return ConversationHandler.END
-            
-            current_due = record.get("due_amount", 0)
-            if amount > current_due:
-                await update.message.reply_text(f"❌ Amount ₹{amount} due amount ₹{current_due} से ज्यादा है!")
+                current = await store.find_one("purchases", {"_id": ObjectId(obj_id_str)}, PROJECTIONS["due_check"])
+                if not current:
+                    await update.message.reply_text("❌ Record not found.")
+                else:
+                    await update.message.reply_text(f"❌ Amount ₹{amount} due amount ₹{current.get('due_amount', 0)} से ज्यादा है!")
                 return ConversationHandler.END
             
-            new_due = current_due - amount
-            payments = record.get("payments", [])
-            
-            # Add new payment entry
-            new_payment = {
-                "amount": amount,
-                "date": fmt(datetime.now()),
-                "type": "partial" if new_due > 0 else "final"
-            }
-            payments.append(new_payment)
-            
-            await asyncio.to_thread(
-                collection.update_one,
-                {"_id": ObjectId(obj_id_str)},
-                {"$set": {"due_amount": new_due, "payments": payments}}
-            )
-            
+            new_due = record.get("due_amount", 0)
             status_msg = "Fully Paid! ✅" if new_due == 0 else f"Remaining Due: ₹{new_due}"
             
             await log_activity("partial_payment", user_id, {
@@ -577,38 +2137,41 @@ async def handle_partial_amount(update: Update, context: ContextTypes.DEFAULT_TY
 async def full_payment_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    _, idx, obj_id_str, client_name = query.data.split("|")
+    payload = await callback_payload(update)
+    if not payload:
+        return ConversationHandler.END
+    obj_id_str, client_name = payload["oid"], payload["client"]
     user_id = query.from_user.id
     
+    if "owner" in payload and not can_access_data(user_id, payload["owner"]):
+        await query.message.reply_text("❌ आपको इस record को modify करने की permission नहीं है।")
+        return ConversationHandler.END
+    
     if db_available and obj_id_str:
         try:
-            record = await asyncio.to_thread(collection.find_one, {"_id": ObjectId(obj_id_str)})
-            if not record:
-                await query.message.reply_text("❌ Record not found.")
-                return ConversationHandler.END
-            
-            record_owner_id = record.get("owner_id", SUPER_ADMIN_ID)
-            if not can_access_data(user_id, record_owner_id):
-                await query.message.reply_text("❌ आपको इस record को modify करने की permission नहीं है।")
-                return ConversationHandler.END
-            
-            current_due = record.get("due_amount", 0)
-            payments = record.get("payments", [])
-            
-            if current_due > 0:
-                new_payment = {
-                    "amount": current_due,
-                    "date": fmt(datetime.now()),
-                    "type": "final"
-                }
-                payments.append(new_payment)
-            
-            await asyncio.to_thread(
-                collection.update_one,
-                {"_id": ObjectId(obj_id_str)},
-                {"$set": {"due_amount": 0, "payments": payments}}
+            guard = {"_id": ObjectId(obj_id_str), "status": "active", "due_amount": {"$gt": 0}}
+            if user_id != SUPER_ADMIN_ID:
+                guard["owner_id"] = user_id
+            record = await ledger_write(
+                store.find_one_and_update(
+                    "purchases", guard, payment_update(None), projection=PROJECTIONS["payment_result"]
+                ),
+                lambda r: r and (r.get("owner_id"), -r["payments"][-1]["amount"], -1),
             )
             
+            if record:
+                current_due = record["payments"][-1]["amount"]
+            else:
+                # Slow path only to explain why nothing was updated
+                existing = await store.find_one("purchases", {"_id": ObjectId(obj_id_str)}, PROJECTIONS["owner_due"])
+                if not existing:
+                    await query.message.reply_text("❌ Record not found.")
+                    return ConversationHandler.END
+                if not can_access_data(user_id, existing.get("owner_id", SUPER_ADMIN_ID)):
+                    await query.message.reply_text("❌ आपको इस record को modify करने की permission नहीं है।")
+                    return ConversationHandler.END
+                current_due = 0
+            
             await log_activity("full_payment", user_id, {
                 "client_name": client_name,
                 "amount_paid": current_due
@@ -626,33 +2189,35 @@ async def full_payment_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def delete_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    _, idx_str, obj_id_str, client_name = query.data.split("|")
+    payload = await callback_payload(update)
+    if not payload:
+        return
     user_id = query.from_user.id
     
-    if db_available:
-        try:
-            record = await asyncio.to_thread(collection.find_one, {"_id": ObjectId(obj_id_str)})
-            if record:
-                record_owner_id = record.get("owner_id", SUPER_ADMIN_ID)
-                if not can_access_data(user_id, record_owner_id):
-                    await query.message.reply_text("❌ आपको इस record को delete करने की permission नहीं है।")
-                    return
-        except:
-            pass
+    record_owner_id = await payload_owner(payload)
+    if record_owner_id is not None and not can_access_data(user_id, record_owner_id):
+        await query.message.reply_text("❌ आपको इस record को delete करने की permission नहीं है।")
+        return
     
-    text = f"Item #{idx_str} delete karne ke liye password dalna hoga."
-    kb = InlineKeyboardMarkup([[InlineKeyboardButton("🔑 Confirm Delete", callback_data=f"pass|{idx_str}|{obj_id_str}|{client_name}")]])
-    try:
-        await query.message.edit_text(text, reply_markup=kb)
-    except:
-        await query.message.reply_text(text, reply_markup=kb)
+    text = f"Item #{payload['idx']} delete karne ke liye password dalna hoga."
+    fields = {k: v for k, v in payload.items() if k != "action"}
+    kb = InlineKeyboardMarkup([[InlineKeyboardButton("🔑 Confirm Delete", callback_data=callback_tokens.issue("pass", **fields))]])
+    await callback_tokens.save()
+    # Reply instead of editing so the history page stays on screen
+    await query.message.reply_text(text, reply_markup=kb)
 
 async def confirm_delete(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    _, idx_str, obj_id_str, client_name = query.data.split("|")
-    context.user_data["delete_obj"] = obj_id_str
-    context.user_data["delete_client"] = client_name
+    payload = await callback_payload(update)
+    if not payload:
+        return ConversationHandler.END
+    record_owner_id = await payload_owner(payload)
+    if record_owner_id is not None and not can_access_data(query.from_user.id, record_owner_id):
+        await query.message.reply_text("❌ आपको इस record को delete करने की permission नहीं है।")
+        return ConversationHandler.END
+    context.user_data["delete_obj"] = payload["oid"]
+    context.user_data["delete_client"] = payload["client"]
     context.user_data["awaiting_delete_pass"] = True
     await query.message.reply_text("Kripya delete password bheje:")
     return ASK_DELETE_PASS
@@ -669,9 +2234,21 @@ async def handle_delete_password(update: Update, context: ContextTypes.DEFAULT_T
         
     if db_available and obj_id_str:
         try:
-            record = await asyncio.to_thread(collection.find_one, {"_id": ObjectId(obj_id_str)})
-            
-            await asyncio.to_thread(collection.update_one, {"_id": ObjectId(obj_id_str)}, {"$set": {"status": "deleted"}})
+            oid = ObjectId(obj_id_str)
+            record = await ledger_write(
+                store.find_one_and_update(
+                    "purchases",
+                    {"_id": oid, "status": {"$ne": "deleted"}},
+                    {"$set": {"status": "deleted"}},
+                    projection=PROJECTIONS["delete_result"],
+                ),
+                lambda r: r and r.get("due_amount", 0) > 0 and (r.get("owner_id"), -r["due_amount"], -1),
+            )
+            inline_cache.clear()
+            expiry_scheduler.cancel(oid)
+            if not record:
+                await update.message.reply_text("❌ Record not found.")
+                return ConversationHandler.END
             
             await log_activity("delete_item", user_id, {
                 "client_name": record.get("client_name", "-") if record else "-",
@@ -696,8 +2273,19 @@ async def handle_delete_password(update: Update, context: ContextTypes.DEFAULT_T
 async def history_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    _, client_name = query.data.split("|")
-    await show_history(client_name, update, context)
+    payload = await callback_payload(update)
+    if payload:
+        await show_history(payload["client"], update, context, page=0)
+
+async def history_page_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    payload = await callback_payload(update)
+    if not payload:
+        return
+    # The tapped message becomes the one that gets edited
+    context.user_data["history_msgs"] = [query.message.message_id]
+    await show_history(payload["client"], update, context, include_deleted=(payload["flag"] == "d"), page=payload["page"])
 
 async def history_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not await check_access(update, context):
@@ -707,7 +2295,9 @@ async def history_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ Usage: /History <client_name>")
         return
     client_name = context.args[0].strip()
-    await show_history(client_name, update, context)
+    if await offer_client_matches(client_name, update, include_deleted=False):
+        return
+    await show_history(client_name, update, context, page=0)
 
 async def delete_history_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not await check_access(update, context):
@@ -717,7 +2307,9 @@ async def delete_history_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE)
         await update.message.reply_text("❌ Usage: /Deletehistory <client_name>")
         return
     client_name = context.args[0].strip()
-    await show_history(client_name, update, context, include_deleted=True)
+    if await offer_client_matches(client_name, update, include_deleted=True):
+        return
+    await show_history(client_name, update, context, include_deleted=True, page=0)
 
 # ---- Duecheck Command ----
 async def duecheck_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -738,59 +2330,23 @@ async def duecheck_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # If no arguments, show all dues
     if len(context.args) == 0:
         try:
-            all_dues = await asyncio.to_thread(lambda: list(
-                collection.find({"status": "active", "due_amount": {"$gt": 0}})
-            ))
+            owner_dues = await fetch_due_totals()
             
-            if not all_dues:
+            if not owner_dues:
                 await update.message.reply_text("✅ कोई pending due नहीं है!")
                 return
             
-            message_lines = ["📊 ALL PENDING DUES:", ""]
-            total_due = 0
-            
-            for entry in all_dues:
-                client_name = entry.get("client_name", "-")
-                apk_name = entry.get("apk_name", "-")
-                due_amount = entry.get("due_amount", 0)
-                total_price = entry.get("total_price", 0)
-                owner_id = entry.get("owner_id", "Unknown")
-                
-                total_due += due_amount
-                
-                message_lines.append(f"👤 Client: {client_name}")
-                message_lines.append(f"📦 APK: {apk_name}")
-                message_lines.append(f"💵 Total: ₹{total_price}")
-                message_lines.append(f"⚠ Due: ₹{due_amount}")
-                message_lines.append(f"👨‍💼 Owner: {owner_id}")
-                message_lines.append("")
+            total_due = round(sum(group["total_due"] for group in owner_dues), 2)
+            writer = ReportWriter(update.message.reply_text, ["📊 ALL PENDING DUES (owner-wise):", ""])
             
-            message_lines.append(f"💰 GRAND TOTAL DUE: ₹{total_due}")
+            for block in await owner_due_lines(owner_dues):
+                await writer.write(*block)
             
-            full_message = "\n".join(message_lines)
-            if len(full_message) <= 4000:
-                await update.message.reply_text(full_message)
-            else:
-                # Split message if too long
-                chunks = []
-                current_chunk = ["📊 ALL PENDING DUES:", ""]
-                current_length = len("\n".join(current_chunk))
-                
-                for line in message_lines[2:-2]:
-                    if current_length + len(line) + 1 > 3800:
-                        chunks.append("\n".join(current_chunk))
-                        current_chunk = [line]
-                        current_length = len(line)
-                    else:
-                        current_chunk.append(line)
-                        current_length += len(line) + 1
-                
-                if current_chunk:
-                    current_chunk.append(f"💰 GRAND TOTAL DUE: ₹{total_due}")
-                    chunks.append("\n".join(current_chunk))
-                
-                for chunk in chunks:
-                    await update.message.reply_text(chunk)
+            await writer.close(
+                f"💰 GRAND TOTAL DUE: ₹{total_due}",
+                "",
+                "ℹ Client-wise list: /Duecheck <client> या /Export status=due",
+            )
                     
         except Exception as e:
             await update.message.reply_text(f"⚠ Error: {e}")
@@ -799,22 +2355,15 @@ async def duecheck_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Show specific client's due
     client_name = context.args[0].strip()
     try:
-        client_entries = await asyncio.to_thread(lambda: list(
-            collection.find({
-                "client_name": {"$regex": f"^{re.escape(client_name)}$", "$options": "i"},
-                "status": "active",
-                "due_amount": {"$gt": 0}
-            })
-        ))
-        
-        if not client_entries:
-            await update.message.reply_text(f"✅ {client_name} का कोई pending due नहीं है!")
-            return
-        
-        message_lines = [f"📊 DUE REPORT for {client_name.upper()}:", ""]
+        query = {
+            "client_key": normalize_client_name(client_name),
+            "status": "active",
+            "due_amount": {"$gt": 0}
+        }
+        writer = ReportWriter(update.message.reply_text, [f"📊 DUE REPORT for {client_name.upper()}:", ""])
         total_client_due = 0
         
-        for entry in client_entries:
+        async for entry in store.iterate("purchases", query, PROJECTIONS["client_due"]):
             apk_name = entry.get("apk_name", "-")
             due_amount = entry.get("due_amount", 0)
             total_price = entry.get("total_price", 0)
@@ -822,12 +2371,14 @@ async def duecheck_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
             
             total_client_due += due_amount
             
-            message_lines.append(f"📦 APK: {apk_name}")
-            message_lines.append(f"💵 Total Price: ₹{total_price}")
-            message_lines.append(f"⚠ Remaining Due: ₹{due_amount}")
+            lines = [
+                f"📦 APK: {apk_name}",
+                f"💵 Total Price: ₹{total_price}",
+                f"⚠ Remaining Due: ₹{due_amount}",
+            ]
             
             if payments:
-                message_lines.append("💳 Payment History:")
+                lines.append("💳 Payment History:")
                 for payment in payments:
                     payment_date = payment.get('date', '-')
                     try:
@@ -835,16 +2386,219 @@ async def duecheck_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
                         formatted_date = dt.strftime("%d %b")
                     except:
                         formatted_date = payment_date
-                    message_lines.append(f"  • Paid ₹{payment.get('amount', 0)} on {formatted_date}")
-            message_lines.append("")
+                    lines.append(f"  • Paid ₹{payment.get('amount', 0)} on {formatted_date}")
+            lines.append("")
+            await writer.write(*lines)
         
-        message_lines.append(f"💰 TOTAL DUE for {client_name.upper()}: ₹{total_client_due}")
+        if not writer.rows:
+            await update.message.reply_text(f"✅ {client_name} का कोई pending due नहीं है!")
+            return
         
-        await update.message.reply_text("\n".join(message_lines))
+        await writer.close(f"💰 TOTAL DUE for {client_name.upper()}: ₹{total_client_due}")
         
     except Exception as e:
         await update.message.reply_text(f"⚠ Error: {e}")
 
+# ---- Export Command ----
+EXPORT_BATCH = 1000  # rows handed to the writer thread at a time
+EXPORT_SPOOL_MEMORY = 8 * 1024 * 1024  # compressed bytes kept in RAM before spilling to disk
+EXPORT_MAX_BYTES = 50 * 1024 * 1024  # Bot API upload limit; also the most held in RAM while sending
+EXPORT_STATUSES = ("active", "due", "deleted", "all")
+EXPORT_COLUMNS = [
+    "record_id", "row_type", "client_name", "apk_name", "owner_id", "status",
+    "purchase_date", "expiry_date", "total_price", "due_amount",
+    "payment_amount", "payment_date", "payment_type",
+]
+EXPORT_USAGE = (
+    "📤 Format: /Export [owner=ID] [from=DD/MM/YYYY] [to=DD/MM/YYYY] [status=active|due|deleted|all]\n"
+    "Example: /Export from=01/09/2026 to=30/09/2026 status=due"
+)
+export_slots = asyncio.Semaphore(EXPORT_CONCURRENCY)
+
+class CsvExport:
+    """gzip'd CSV in a spooled temp file; only the compressed bytes are buffered.
+
+    All methods block, so the caller runs them through asyncio.to_thread.
+    """
+
+    def __init__(self):
+        self.file = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_MEMORY)
+        self.gzip = gzip.GzipFile(fileobj=self.file, mode="wb")
+        # utf-8-sig so Excel shows Hindi client names correctly
+        self.text = io.TextIOWrapper(self.gzip, encoding="utf-8-sig", newline="")
+        self.writer = csv.writer(self.text)
+        self.writer.writerow(EXPORT_COLUMNS)
+
+    def write_rows(self, rows: list):
+        self.writer.writerows(rows)
+
+    def finish(self) -> int:
+        """Close the gzip stream, rewind and return the file size"""
+        self.text.flush()
+        self.text.detach()
+        self.gzip.close()
+        size = self.file.tell()
+        self.file.seek(0)
+        return size
+
+    def close(self):
+        self.file.close()
+
+def export_rows(doc: dict) -> list:
+    """One purchase row followed by one row per payment"""
+    base = [
+        str(doc["_id"]), "", doc.get("client_name", ""), doc.get("apk_name", ""),
+        doc.get("owner_id") or SUPER_ADMIN_ID, doc.get("status", ""),
+        fmt_stored(doc.get("purchase_date")), fmt_stored(doc.get("expiry_date")),
+        doc.get("total_price", 0), doc.get("due_amount", 0),
+    ]
+    rows = [base[:1] + ["purchase"] + base[2:] + ["", "", ""]]
+    for payment in doc.get("payments") or []:
+        rows.append(base[:1] + ["payment"] + base[2:] + [
+            payment.get("amount", ""), payment.get("date", ""), payment.get("type", ""),
+        ])
+    return rows
+
+def date_range_filter(field: str, start: datetime | None, end: datetime | None) -> dict:
+    """Range on a stored date, also matching fmt() strings until the date migration finishes"""
+    bounds = {}
+    if start:
+        bounds["$gte"] = start
+    if end:
+        bounds["$lt"] = end
+    if date_migration_done:
+        return {field: bounds}
+    legacy = {"$type": "string", **{op: fmt(value) for op, value in bounds.items()}}
+    return {"$or": [{field: bounds}, {field: legacy}]}
+
+def build_export_query(args: list[str], user_id: int) -> tuple[dict, str]:
+    """Parse /Export key=value args into a purchases filter; ValueError carries the reply"""
+    options = {}
+    for arg in args:
+        key, sep, value = arg.partition("=")
+        key = key.strip().lower()
+        if not sep or key not in ("owner", "from", "to", "status"):
+            raise ValueError(EXPORT_USAGE)
+        options[key] = value.strip()
+    
+    clauses = []
+    status = options.get("status", "active").lower()
+    if status not in EXPORT_STATUSES:
+        raise ValueError(EXPORT_USAGE)
+    if status == "due":
+        clauses.append({"status": "active", "due_amount": {"$gt": 0}})
+    elif status != "all":
+        clauses.append({"status": status})
+    
+    owner_id = None
+    if "owner" in options:
+        try:
+            owner_id = int(options["owner"])
+        except ValueError:
+            raise ValueError("❌ Owner ID number होना चाहिए।")
+    if user_id != SUPER_ADMIN_ID:
+        if owner_id not in (None, user_id):
+            raise ValueError("❌ आप केवल अपने records export कर सकते हैं।")
+        owner_id = user_id
+    if owner_id is not None:
+        clauses.append({"owner_id": owner_id})
+    
+    start = end = None
+    if "from" in options:
+        start = parse_ddmmyyyy(options["from"])
+        if not start:
+            raise ValueError("❌ from= date DD/MM/YYYY format में दें।")
+    if "to" in options:
+        end = parse_ddmmyyyy(options["to"])
+        if not end:
+            raise ValueError("❌ to= date DD/MM/YYYY format में दें।")
+        end += timedelta(days=1)  # inclusive
+    if start and end and start >= end:
+        raise ValueError("❌ from date, to date से पहले होनी चाहिए।")
+    if start or end:
+        clauses.append(date_range_filter("purchase_date", start, end))
+    
+    summary = [f"status={status}"]
+    if owner_id is not None:
+        summary.append(f"owner={owner_id}")
+    if start:
+        summary.append(f"from={start.strftime('%d/%m/%Y')}")
+    if end:
+        summary.append(f"to={(end - timedelta(days=1)).strftime('%d/%m/%Y')}")
+    query = clauses[0] if len(clauses) == 1 else {"$and": clauses}
+    return query, ", ".join(summary)
+
+async def write_export(query: dict) -> tuple[CsvExport, int]:
+    """Stream matching purchases into a CsvExport; returns it with the purchase count"""
+    export = await asyncio.to_thread(CsvExport)
+    purchases = 0
+    rows = []
+    try:
+        async for doc in store.iterate("purchases", query, PROJECTIONS["export"], batch_size=EXPORT_BATCH):
+            rows.extend(export_rows(doc))
+            purchases += 1
+            if len(rows) >= EXPORT_BATCH:
+                await asyncio.to_thread(export.write_rows, rows)
+                rows = []
+        if rows:
+            await asyncio.to_thread(export.write_rows, rows)
+    except:
+        await asyncio.to_thread(export.close)
+        raise
+    return export, purchases
+
+async def export_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Export purchases + payments as a gzip'd CSV document"""
+    user_id = update.effective_user.id if update.effective_user else None
+    if not await check_access(update, context):
+        return
+    update_last_activity(update, context)
+    
+    if not db_available:
+        await update.message.reply_text("⚠ Database unavailable.")
+        return
+    
+    try:
+        query, summary = build_export_query(context.args, user_id)
+    except ValueError as e:
+        await update.message.reply_text(str(e))
+        return
+    
+    if export_slots.locked():
+        await update.message.reply_text("⏳ अभी दूसरे exports चल रहे हैं, थोड़ी देर बाद try करें।")
+        return
+    
+    async with export_slots:
+        status_msg = await update.message.reply_text(f"📤 Export बन रहा है... ({summary})")
+        export = None
+        try:
+            export, purchases = await write_export(query)
+            if not purchases:
+                await status_msg.edit_text(f"📭 कोई record नहीं मिला ({summary})")
+                return
+            size = await asyncio.to_thread(export.finish)
+            if size > EXPORT_MAX_BYTES:
+                await status_msg.edit_text("❌ Export 50MB से बड़ा है, filter (owner/date) लगाकर दोबारा try करें।")
+                return
+            
+            filename = f"purchases_{datetime.now().strftime('%Y%m%d_%H%M')}.csv.gz"
+            # PTB reads a file object in one blocking call; read it off the event loop instead
+            data = await asyncio.to_thread(export.file.read)
+            await context.bot.send_document(
+                chat_id=update.effective_chat.id,
+                document=data,
+                filename=filename,
+                caption=f"📤 {purchases} records ({summary})",
+                write_timeout=120,
+            )
+            await status_msg.delete()
+            await log_activity("export", user_id, {"filters": summary, "records": purchases, "bytes": size})
+        except Exception as e:
+            await update.message.reply_text(f"⚠ Error: {e}")
+        finally:
+            if export:
+                await asyncio.to_thread(export.close)
+
 # ---- Admin Management Commands ----
 async def ownerid_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Show all registered admins"""
@@ -874,11 +2628,67 @@ async def ownerid_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
             user_id_display = admin.get("user_id")
             message_lines.append(f"{i}. Username: {username} | ID: {user_id_display}")
         
+        cache = admin_registry.stats()
+        message_lines.append("")
+        message_lines.append(f"🗂 Access cache: {cache['hits']} hits | {cache['misses']} misses")
+        if store is not None:
+            pool = store.stats()
+            message_lines.append(f"🗄 DB pool: {pool['in_use']}/{pool['pool_size']} in use | {pool['open']} open | {pool['waiting']} waiting | {pool['timeouts']} timeouts")
+        tokens = callback_tokens.stats()
+        message_lines.append(f"🔘 Button tokens: {tokens['size']} cached | {tokens['hits']} hits | {tokens['loads']} loaded | {tokens['misses']} expired")
+        logs = activity_sink.stats()
+        message_lines.append(f"📝 Activity log: {logs['queued']} queued | {logs['written']} written | {logs['dropped']} dropped")
+        if isinstance(context.application, OrderedApplication):
+            upd = context.application.update_stats()
+            message_lines.append(f"⚙ Updates: {upd['running']}/{upd['limit']} running | {upd['waiting']} waiting | {upd['queued']} queued")
+        
         await update.message.reply_text("\n".join(message_lines))
         
     except Exception as e:
         await update.message.reply_text(f"⚠ Error: {e}")
 
+async def metrics_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Short latency/error summary for Super Admin"""
+    user_id = update.effective_user.id if update.effective_user else None
+    if not await check_access(update, context):
+        return
+    update_last_activity(update, context)
+    
+    if user_id != SUPER_ADMIN_ID:
+        await update.message.reply_text("❌ यह command केवल Super Admin use कर सकते हैं।")
+        return
+    
+    uptime = int(monotonic() - metrics.started)
+    message_lines = [f"📈 Metrics (uptime {uptime // 3600}h {uptime % 3600 // 60}m)", ""]
+    message_lines.extend(metrics.summary() or ["अभी कोई data नहीं है।"])
+    await update.message.reply_text("\n".join(message_lines).strip())
+
+async def reconcile_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Rebuild the per-owner due ledger from purchases (Super Admin)"""
+    user_id = update.effective_user.id if update.effective_user else None
+    if not await check_access(update, context):
+        return
+    update_last_activity(update, context)
+    
+    if user_id != SUPER_ADMIN_ID:
+        await update.message.reply_text("❌ यह command केवल Super Admin use कर सकते हैं।")
+        return
+    
+    if not db_available:
+        await update.message.reply_text("⚠ Database unavailable.")
+        return
+    
+    try:
+        result = await rebuild_due_ledger()
+        await log_activity("due_ledger_reconcile", user_id, result)
+        await update.message.reply_text(
+            f"✅ Due ledger rebuilt\n"
+            f"👨‍💼 Owners with dues: {result['owners']}\n"
+            f"🔧 Corrected: {result['corrected']} (drift ₹{result['drift']})"
+        )
+    except Exception as e:
+        await update.message.reply_text(f"⚠ Error: {e}")
+
 async def addid_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Add admin command"""
     user_id = update.effective_user.id if update.effective_user else None
@@ -911,7 +2721,7 @@ async def addid_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     try:
         # Check if already exists
-        existing = await asyncio.to_thread(admins_collection.find_one, {"user_id": new_admin_id})
+        existing = await store.find_one("admins", {"user_id": new_admin_id}, PROJECTIONS["exists"])
         if existing:
             await update.message.reply_text("❌ यह admin पहले से registered है!")
             return
@@ -967,15 +2777,16 @@ async def removeid_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     try:
         # Check if exists
-        existing = await asyncio.to_thread(admins_collection.find_one, {"user_id": remove_admin_id})
+        existing = await store.find_one("admins", {"user_id": remove_admin_id}, PROJECTIONS["exists"])
         if not existing:
             await update.message.reply_text("❌ यह admin registered नहीं है!")
             return
         
         # Remove from database
-        await asyncio.to_thread(admins_collection.update_one, 
-                              {"user_id": remove_admin_id}, 
-                              {"$set": {"status": "removed"}})
+        await store.update_one("admins", 
+                               {"user_id": remove_admin_id}, 
+                               {"$set": {"status": "removed"}})
+        admin_registry.discard(remove_admin_id)
         
         # Send notifications
         await update.message.reply_text("❌ Admin removed successfully")
@@ -1007,6 +2818,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     update_last_activity(update, context)
     context.user_data["wrong_count"] = 0
     context.user_data["reg_in_progress"] = True
+    context.user_data.pop("purchase_id", None)
     user_name = (update.effective_user.first_name or "User") if update.effective_user else "User"
     await update.message.reply_text(f"Hi Mr. {user_name}")
     await asyncio.sleep(1)
@@ -1195,11 +3007,16 @@ async def confirm_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     now = datetime.now()
     
     if db_available:
+        # The _id is fixed before the first attempt so a retried Confirm can't
+        # insert the purchase twice when an earlier insert timed out but committed
+        purchase_id = ObjectId(context.user_data.setdefault("purchase_id", str(ObjectId())))
         record = {
+            "_id": purchase_id,
             "client_name": client_name,
+            "client_key": normalize_client_name(client_name),
             "apk_name": apk_name,
-            "purchase_date": fmt(purchase_dt),
-            "expiry_date": fmt(expiry),
+            "purchase_date": purchase_dt,
+            "expiry_date": expiry,
             "total_price": total_price,
             "due_amount": total_price,  # Initially full amount is due
             "status": "active",
@@ -1207,9 +3024,27 @@ async def confirm_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "added_by": user_id,
             "owner_username": context.user_data.get("owner_username", ""),
             "owner_id": owner_id,
-            "created_at": fmt(now),
+            "created_at": now,
         }
-        await asyncio.to_thread(collection.insert_one, record)
+        try:
+            await ledger_write(store.insert_one("purchases", record), lambda _: (owner_id, total_price, 1))
+        except DuplicateKeyError:
+            # An earlier attempt was saved after we gave up on it; its ledger entry was skipped
+            await ledger_write(
+                store.find_one("purchases", {"_id": purchase_id}, PROJECTIONS["exists"]),
+                lambda doc: (owner_id, total_price, 1) if doc else None,
+            )
+        except (asyncio.TimeoutError, PyMongoError) as e:
+            print(f"⚠ Purchase save error: {e!r}")
+            await query.message.reply_text(
+                "⚠ Save confirm नहीं हो पाया — record save हुआ या नहीं पता नहीं।\n"
+                "थोड़ी देर बाद ✅ Confirm दुबारा दबाएं, duplicate नहीं बनेगा।")
+            return None  # stay on the confirm step with the same purchase_id
+        expiry_scheduler.add(record["_id"], expiry)
+        try:
+            await client_directory.add(client_name, owner_id)
+        except Exception as e:
+            print(f"⚠ Client directory update error: {e}")
         
         await log_activity("registration", user_id, {
             "client_name": client_name,
@@ -1237,77 +3072,595 @@ async def confirm_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"💰 Due Amount: ₹{total_price}",
     ]
     await query.message.reply_text("\n".join(lines))
-    keyboard = [[InlineKeyboardButton("📜 Show History", callback_data=f"history|{client_name}")]]
+    keyboard = [[InlineKeyboardButton("📜 Show History", callback_data=callback_tokens.issue("history", client=client_name))]]
+    await callback_tokens.save()
     await query.message.reply_text("History dekhne ke liye niche button dabaye 👇", reply_markup=InlineKeyboardMarkup(keyboard))
     
     # Clean up user data
-    for key in ["pending_apk", "purchase_date", "total_price", "owner_id", "client_name", "reg_in_progress", "confirmation_msg_id", "chat_id"]:
+    for key in ["pending_apk", "purchase_date", "total_price", "owner_id", "client_name", "reg_in_progress", "confirmation_msg_id", "chat_id", "purchase_id"]:
         context.user_data.pop(key, None)
     
     return ConversationHandler.END
 
 # ---- Scheduled Tasks ----
-async def daily_expiry_check(context: ContextTypes.DEFAULT_TYPE):
-    """Daily scheduled expiry check"""
-    await check_expiring_apks(context)
-
 async def daily_due_check(context: ContextTypes.DEFAULT_TYPE):
     """Daily scheduled due payment check at 3 PM"""
     await daily_due_payment_check(context)
 
+async def delete_chat_messages(bot, chat_id: int, message_ids: list[int]):
+    """Delete messages in as few rate-limited calls as the Bot API version allows"""
+    if not message_ids:
+        return
+    if hasattr(bot, "delete_messages"):
+        # Bot API 7.0+: up to 100 messages per call
+        for start in range(0, len(message_ids), 100):
+            await dispatcher.global_bucket.acquire()
+            try:
+                await bot.delete_messages(chat_id=chat_id, message_ids=message_ids[start:start + 100])
+            except:
+                pass
+        return
+    for msg_id in message_ids:
+        await dispatcher.global_bucket.acquire()
+        try:
+            await bot.delete_message(chat_id=chat_id, message_id=msg_id)
+        except:
+            pass
+
+async def clear_inactive_session(context: ContextTypes.DEFAULT_TYPE, user_id: int):
+    application = context.application
+    user_data = application.user_data.get(user_id)
+    if not user_data:
+        return
+    last_activity = user_data.get("last_activity")
+    if not isinstance(last_activity, datetime):
+        return
+    if datetime.now() - last_activity < inactivity_index.timeout:
+        inactivity_index.touch(user_id, last_activity)  # active again meanwhile
+        return
+    try:
+        await delete_chat_messages(context.bot, user_id, user_data.get("history_msgs", []))
+        application.drop_user_data(user_id)
+        await dispatcher.send(
+            context.bot, user_id,
+            "🧹 Chat history cleared due to inactivity.\n\nUse /Start to begin fresh! 🚀"
+        )
+        print(f"🧹 Cleared inactive chat for user: {user_id}")
+    except Exception as e:
+        print(f"⚠ Error clearing chat for {user_id}: {e}")
+
 async def clear_chat_if_inactive(context: ContextTypes.DEFAULT_TYPE):
-    """Clear chat history if bot is inactive for 1 hour"""
-    current_time = datetime.now()
-    
-    for chat_id, user_data in context.application.user_data.items():
-        last_activity = user_data.get("last_activity")
-        
-        if last_activity:
-            time_diff = current_time - last_activity
-            if time_diff.total_seconds() > 3600:
-                try:
-                    history_msgs = user_data.get("history_msgs", [])
-                    for msg_id in history_msgs:
-                        try:
-                            await context.bot.delete_message(chat_id=chat_id, message_id=msg_id)
-                        except:
-                            pass
-                    
-                    user_data.clear()
-                    await context.bot.send_message(
-                        chat_id=chat_id,
-                        text="🧹 Chat history cleared due to inactivity.\n\nUse /Start to begin fresh! 🚀"
-                    )
-                    print(f"🧹 Cleared inactive chat for user: {chat_id}")
-                except Exception as e:
-                    print(f"⚠ Error clearing chat for {chat_id}: {e}")
+    """Clear chat history for sessions inactive for INACTIVITY_TIMEOUT (only expired ones are visited)"""
+    expired = inactivity_index.pop_expired(datetime.now())
+    if expired:
+        await asyncio.gather(*(clear_inactive_session(context, user_id) for user_id in expired))
 
 def schedule_daily_tasks(app):
     """Schedule daily tasks"""
     job_queue = app.job_queue
     if job_queue:
-        # Schedule daily expiry check at 9:00 AM
-        job_queue.run_daily(daily_expiry_check, time=time(hour=9, minute=0))
-        print("✅ Daily expiry check scheduled for 9:00 AM")
+        # Expiry reminders fire from ExpiryScheduler's own timer once Mongo is loaded
+        expiry_scheduler.attach(app)
+        print(f"✅ Expiry reminders at {EXPIRY_NOTIFY_HOUR}:00, {EXPIRY_REMINDER_DAYS} days before expiry")
         
         # Schedule daily due payment check at 3:00 PM
-        job_queue.run_daily(daily_due_check, time=time(hour=15, minute=0))
+        job_queue.run_daily(instrumented(daily_due_check, "job"), time=time(hour=15, minute=0))
         print("✅ Daily due payment check scheduled for 3:00 PM")
         
-        # Schedule auto-clear every hour
-        job_queue.run_repeating(clear_chat_if_inactive, interval=3600, first=3600)
-        print("✅ Auto-clear chat scheduled every 1 hour")
+        # Sweep inactive sessions (only expired ones are visited)
+        job_queue.run_repeating(instrumented(clear_chat_if_inactive, "job"), interval=SWEEP_INTERVAL, first=SWEEP_INTERVAL)
+        print(f"✅ Auto-clear chat sweeper every {SWEEP_INTERVAL}s ({INACTIVITY_TIMEOUT}s inactivity)")
+
+# ---- DB Indexes & Migrations ----
+async def ensure_indexes():
+    """Create the indexes the lookup queries rely on"""
+    await store.create_index(
+        "purchases",
+        [("client_key", ASCENDING), ("status", ASCENDING), ("purchase_date", ASCENDING)],
+        name="client_key_status_purchase_date",
+    )
+    await store.create_index(
+        "purchases",
+        [("status", ASCENDING), ("expiry_date", ASCENDING)],
+        name="status_expiry_date",
+    )
+    await store.create_index("sessions", [("kind", ASCENDING), ("name", ASCENDING)], name="kind_name")
+    await store.create_index(
+        "callback_tokens", [("created_at", ASCENDING)], name="created_at_ttl", expireAfterSeconds=CALLBACK_TOKEN_TTL
+    )
 
-# ---- Main Function ----
-def main():
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
+async def migrate_client_keys(batch_size: int = 1000):
+    """One-time backfill of client_key on purchases saved before it existed"""
+    marker = await store.find_one("meta", {"_id": "client_key_migration"}, PROJECTIONS["marker"])
+    if marker and marker.get("done"):
+        return
+
+    updated = 0
+    while True:
+        docs = await store.find("purchases", {"client_key": {"$exists": False}}, PROJECTIONS["client_key_backfill"], limit=batch_size)
+        if not docs:
+            break
+        ops = [
+            UpdateOne({"_id": doc["_id"]}, {"$set": {"client_key": normalize_client_name(doc.get("client_name", ""))}})
+            for doc in docs
+        ]
+        await store.bulk_write("purchases", ops)
+        updated += len(ops)
+
+    await store.update_one(
+        "meta",
+        {"_id": "client_key_migration"},
+        {"$set": {"done": True, "updated": updated, "finished_at": datetime.now()}},
+        upsert=True,
+    )
+    print(f"✅ client_key migration done ({updated} records updated)")
+
+async def build_client_directory(batch_size: int = 1000):
+    """One-time backfill of the clients collection from purchases, then load it"""
+    marker = await store.find_one("meta", {"_id": "clients_directory"}, PROJECTIONS["marker"])
+    if not (marker and marker.get("done")):
+        pipeline = [
+            {"$group": {
+                "_id": "$client_key",
+                "name": {"$last": "$client_name"},
+                "owners": {"$addToSet": {"$ifNull": ["$owner_id", SUPER_ADMIN_ID]}},
+            }},
+            {"$match": {"_id": {"$nin": [None, ""]}}},
+        ]
+        clients = await store.aggregate("purchases", pipeline, timeout=120)
+        for i in range(0, len(clients), batch_size):
+            ops = [
+                UpdateOne(
+                    {"_id": c["_id"]},
+                    {"$set": {"name": c["name"]}, "$addToSet": {"owners": {"$each": c["owners"]}}},
+                    upsert=True,
+                )
+                for c in clients[i:i + batch_size]
+            ]
+            await store.bulk_write("clients", ops)
+        await store.update_one(
+            "meta",
+            {"_id": "clients_directory"},
+            {"$set": {"done": True, "clients": len(clients), "finished_at": datetime.now()}},
+            upsert=True,
+        )
+        print(f"✅ Client directory built ({len(clients)} clients)")
+    await client_directory.load()
+
+async def migrate_dates(batch_size: int = 500, pause: float = 0.5):
+    """Background conversion of fmt() date strings to BSON datetimes, in batches"""
+    global date_migration_done
+    marker = await store.find_one("meta", {"_id": "date_migration"}, PROJECTIONS["marker"])
+    if marker and marker.get("done"):
+        date_migration_done = True
+        return
+
+    legacy = {"$or": [{field: {"$type": "string"}} for field in DATE_FIELDS]}
+
+    async def convert_batch():
+        ops = []
+        for doc in await store.find("purchases", legacy, PROJECTIONS["date_backfill"], limit=batch_size):
+            changes = {}
+            for field in DATE_FIELDS:
+                value = doc.get(field)
+                if isinstance(value, str):
+                    parsed = as_datetime(value)
+                    changes[field] = parsed
+                    if parsed is None:
+                        # Keep unparseable values around without re-selecting them next batch
+                        changes[f"{field}_legacy"] = value
+            ops.append(UpdateOne({"_id": doc["_id"]}, {"$set": changes}))
+        if ops:
+            await store.bulk_write("purchases", ops)
+        return len(ops)
+
+    converted = 0
+    while True:
+        try:
+            count = await convert_batch()
+        except Exception as e:
+            print(f"⚠ Date migration batch error: {e}")
+            await asyncio.sleep(30)
+            continue
+        if count == 0:
+            break
+        converted += count
+        await asyncio.sleep(pause)
+
+    await store.update_one(
+        "meta",
+        {"_id": "date_migration"},
+        {"$set": {"done": True, "converted": converted, "finished_at": datetime.now()}},
+        upsert=True,
+    )
+    date_migration_done = True
+    print(f"✅ Date migration done ({converted} records converted)")
+
+# ---- DB Connection Supervisor ----
+DB_CONNECT_TIMEOUT = float(os.getenv("DB_CONNECT_TIMEOUT", "5"))  # seconds per connect/ping attempt
+DB_STARTUP_WAIT = float(os.getenv("DB_STARTUP_WAIT", "2"))  # max seconds startup waits for Mongo
+DB_HEALTH_INTERVAL = float(os.getenv("DB_HEALTH_INTERVAL", "30"))  # seconds between pings while up
+DB_RETRY_MAX = 60  # longest backoff between reconnect attempts
+
+class DbSupervisor:
+    """Connects to MongoDB in the background and keeps db_available in sync.
+
+    Startup only waits DB_STARTUP_WAIT for the first connect. The first
+    successful connect runs the deferred startup steps (indexes, migrations,
+    admin cache); afterwards a periodic ping turns DB features off when Mongo
+    stops answering and back on when it returns.
+    """
+
+    def __init__(self):
+        self.task = None
+        self.deadline = 0.0  # startup stops waiting for Mongo after this
+        self.connected = asyncio.Event()
+        self.startup_done = False
+        self.failures = 0  # consecutive failed checks
+        self.last_error = None
+
+    def start(self):
+        if self.task is None and store is not None:
+            self.deadline = monotonic() + DB_STARTUP_WAIT
+            self.task = spawn_background(self._run())
+
+    async def wait_startup(self) -> bool:
+        """Wait for Mongo at most DB_STARTUP_WAIT in total, however often it is called"""
+        self.start()
+        remaining = self.deadline - monotonic()
+        if self.task is not None and remaining > 0:
+            try:
+                await asyncio.wait_for(self.connected.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+        return db_available
+
+    async def _run(self):
+        delay = 1
+        while True:
+            if await self.check():
+                delay = 1
+                await asyncio.sleep(DB_HEALTH_INTERVAL)
+            else:
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, DB_RETRY_MAX)
+
+    async def check(self) -> bool:
+        global db_available
+        started = monotonic()
+        try:
+            await store.connect(DB_CONNECT_TIMEOUT)
+        except Exception as e:
+            self.last_error = str(e) or type(e).__name__
+            if not self.failures:
+                print(f"⚠ MongoDB unreachable, DB features off: {self.last_error}")
+            self.failures += 1
+            db_available = False
+            self.connected.clear()
+            return False
+
+        self.failures = 0
+        if not db_available:
+            db_available = True
+            if self.startup_done:
+                print("✅ MongoDB reachable again, DB features on")
+                admin_registry.invalidate()
+            else:
+                metrics.mark_startup("db_connect", monotonic() - started)
+                print("✅ MongoDB connected")
+        self.connected.set()
+        if not self.startup_done:
+            await self._deferred_startup()
+        return True
+
+    async def _deferred_startup(self):
+        """One-time DB setup; retried on the next check if a step fails"""
+        steps = [
+            ("indexes", ensure_indexes),
+            ("client_key_migration", migrate_client_keys),
+            ("due_ledger", ensure_due_ledger),
+            ("client_directory", build_client_directory),
+            ("expiry_scheduler", expiry_scheduler.load),
+            ("admin_cache", admin_registry.refresh),
+        ]
+        for step, run in steps:
+            if step in metrics.startup:
+                continue
+            started = monotonic()
+            try:
+                await run()
+            except Exception as e:
+                print(f"⚠ Startup step {step} failed (will retry): {e}")
+                return
+            metrics.mark_startup(step, monotonic() - started)
+        spawn_background(migrate_dates())
+        self.startup_done = True
+        print(f"✅ Admin registry loaded ({len(admin_registry.admin_ids)} admins)")
+
+    async def close(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+db_supervisor = DbSupervisor()
+
+async def post_init(app):
+    """Start background services; Mongo connects without holding up startup"""
+    if not await db_supervisor.wait_startup():
+        print(f"⚠ MongoDB not ready after {DB_STARTUP_WAIT}s, starting without DB (retrying in background)")
+    activity_sink.start()
+    if metrics_server:
+        try:
+            await metrics_server.start()
+        except OSError as e:
+            print(f"⚠ Metrics server fail: {e}")
+
+    # Sessions restored by persistence go back into the inactivity index
+    for user_id, user_data in app.user_data.items():
+        if isinstance(user_data.get("last_activity"), datetime):
+            inactivity_index.touch(user_id, user_data["last_activity"])
+    metrics.mark_startup("ready", monotonic() - metrics.started)
+    print(f"✅ Startup finished in {metrics.startup['ready']:.2f}s")
+
+async def post_shutdown(app):
+    """Flush buffered writes before the process exits"""
+    await db_supervisor.close()
+    await activity_sink.close()
+    print(f"✅ Activity log flushed ({activity_sink.stats()})")
+    if metrics_server:
+        await metrics_server.close()
+
+# ---- Session Persistence ----
+class MongoPersistence(BasePersistence):
+    """Keeps user_data and conversation states in the sessions collection.
+
+    PTB already tracks which users/conversations changed and hands them over
+    every PERSISTENCE_INTERVAL seconds; those are staged here and written as a
+    single bulk_write, so handlers never wait on session writes.
+
+    This makes sessions survive a restart; it does not share them between
+    processes. Everything is read once at startup (PTB has no per-update
+    reload for conversation states), and with write-behind another process
+    would see changes up to PERSISTENCE_INTERVAL late and overwrite them.
+    Run one bot process per sessions collection.
+    """
+
+    def __init__(self, update_interval: float):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, callback_data=False),
+            update_interval=update_interval,
+        )
+        self._staged: dict[str, dict | None] = {}  # _id -> replacement doc, None = delete
+        self._flush_task = None
+
+    async def _load(self, query: dict, projection: dict) -> list:
+        if not await db_supervisor.wait_startup():
+            print("⚠ Sessions not loaded (DB unavailable), starting with empty sessions")
+            return []
+        try:
+            return await store.find("sessions", query, projection, timeout=15)
+        except Exception as e:
+            print(f"⚠ Session load error (starting with empty sessions): {e}")
+            return []
+
+    async def get_user_data(self) -> dict:
+        return {doc["key"]: doc.get("data") or {} for doc in await self._load({"kind": "user"}, PROJECTIONS["session_user"])}
+
+    async def get_chat_data(self) -> dict:
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name: str) -> dict:
+        docs = await self._load({"kind": "conv", "name": name}, PROJECTIONS["session_conv"])
+        return {tuple(doc["key"]): doc["state"] for doc in docs}
+
+    def _stage(self, doc_id: str, doc: dict | None):
+        if doc is not None:
+            try:
+                bson.encode(doc)
+            except Exception as e:
+                print(f"⚠ Session {doc_id} not saved: {e}")
+                return
+        self._staged[doc_id] = doc
+        if self._flush_task is None or self._flush_task.done():
+            # Runs once the current update_persistence round has staged everything
+            self._flush_task = spawn_background(self._write_staged())
+
+    async def _write_staged(self):
+        if not self._staged or not db_available:
+            return
+        staged, self._staged = self._staged, {}
+        ops = [
+            ReplaceOne({"_id": doc_id}, doc, upsert=True) if doc is not None else DeleteOne({"_id": doc_id})
+            for doc_id, doc in staged.items()
+        ]
+        try:
+            await store.bulk_write("sessions", ops)
+        except Exception as e:
+            print(f"⚠ Session flush error: {e}")
+            # Keep anything staged meanwhile, it is newer
+            self._staged = {**staged, **self._staged}
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        self._stage(f"user:{user_id}", {"kind": "user", "key": user_id, "data": data})
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._stage(f"user:{user_id}", None)
+
+    async def update_conversation(self, name: str, key: tuple, new_state) -> None:
+        doc_id = f"conv:{name}:" + ":".join(str(k) for k in key)
+        if new_state is None:
+            self._stage(doc_id, None)
+        else:
+            self._stage(doc_id, {"kind": "conv", "name": name, "key": list(key), "state": new_state})
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        pass
+
+    async def update_bot_data(self, data: dict) -> None:
+        pass
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        pass  # this process owns its sessions, memory is always current
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        pass
+
+    async def flush(self) -> None:
+        if self._flush_task and not self._flush_task.done():
+            await self._flush_task
+        await self._write_staged()
+
+def build_persistence():
+    """Mongo-backed sessions, falling back to a local pickle file"""
+    if PERSISTENCE == "none":
+        return None
+    if PERSISTENCE == "mongo" and store is not None:
+        return MongoPersistence(PERSISTENCE_INTERVAL)
+    return PicklePersistence(
+        filepath=PERSISTENCE_FILE,
+        store_data=PersistenceInput(bot_data=False, chat_data=False, callback_data=False),
+        update_interval=PERSISTENCE_INTERVAL,
+    )
+
+# ---- Application Setup ----
+class OrderedApplication(Application):
+    """Runs updates from different users in parallel, each user's updates in arrival order.
+
+    PTB's own concurrency cap is set high; the real limit (UPDATE_CONCURRENCY) is
+    taken only after the per-user lock, so updates queued behind a busy user
+    don't occupy slots other users could use. Holding the lock for the whole
+    update keeps ConversationHandler state and user_data consistent.
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.handler_slots = asyncio.Semaphore(max(UPDATE_CONCURRENCY, 1))
+        self.user_locks: dict[int, asyncio.Lock] = {}
+        self.user_pending: dict[int, int] = {}
+        self.updates_waiting = 0
+        self.updates_running = 0
+        self.updates_processed = 0
+        metrics.add_gauges(self.metric_gauges)
+
+    @staticmethod
+    def _ordering_key(update):
+        if isinstance(update, Update):
+            if update.effective_user:
+                return update.effective_user.id
+            if update.effective_chat:
+                return update.effective_chat.id
+        return None
+
+    async def process_update(self, update: object) -> None:
+        key = self._ordering_key(update)
+        lock = None
+        if key is not None:
+            lock = self.user_locks.setdefault(key, asyncio.Lock())
+            self.user_pending[key] = self.user_pending.get(key, 0) + 1
+        self.updates_waiting += 1
+        started = False
+        arrived = monotonic()
+        try:
+            if lock:
+                await lock.acquire()
+            try:
+                async with self.handler_slots:
+                    self.updates_waiting -= 1
+                    started = True
+                    metrics.observe("queue", "update_wait", monotonic() - arrived)
+                    self.updates_running += 1
+                    try:
+                        await super().process_update(update)
+                    finally:
+                        self.updates_running -= 1
+                        self.updates_processed += 1
+            finally:
+                if lock:
+                    lock.release()
+        finally:
+            if not started:
+                self.updates_waiting -= 1
+            if key is not None:
+                self.user_pending[key] -= 1
+                if not self.user_pending[key]:
+                    del self.user_pending[key]
+                    self.user_locks.pop(key, None)
+
+    def update_stats(self) -> dict:
+        return {
+            "queued": self.update_queue.qsize(),
+            "waiting": self.updates_waiting,
+            "running": self.updates_running,
+            "active_users": len(self.user_pending),
+            "deepest_user": max(self.user_pending.values(), default=0),
+            "processed": self.updates_processed,
+            "limit": UPDATE_CONCURRENCY,
+        }
+
+    def metric_gauges(self) -> list[tuple]:
+        stats = self.update_stats()
+        return [
+            ("bot_updates_queued", "gauge", "Updates fetched but not yet dispatched", stats["queued"]),
+            ("bot_updates_waiting", "gauge", "Updates waiting for their user's turn or a free slot", stats["waiting"]),
+            ("bot_updates_running", "gauge", "Updates being handled", stats["running"]),
+            ("bot_updates_active_users", "gauge", "Users with updates waiting or running", stats["active_users"]),
+            ("bot_updates_user_depth_max", "gauge", "Most updates pending for a single user", stats["deepest_user"]),
+            ("bot_updates_processed_total", "counter", "Updates handled since start", stats["processed"]),
+        ]
+
+def instrument_handlers(app):
+    """Time every registered callback, including the conversation's states"""
+    for handlers in app.handlers.values():
+        for handler in handlers:
+            if isinstance(handler, ConversationHandler):
+                inner = handler.entry_points + handler.fallbacks
+                inner += [h for state_handlers in handler.states.values() for h in state_handlers]
+            else:
+                inner = [handler]
+            for h in inner:
+                h.callback = instrumented(h.callback)
+
+def build_application(run_scheduler: bool = RUN_SCHEDULER):
+    """Build the Application with all handlers (shared by polling and webhook mode)"""
+    builder = (
+        ApplicationBuilder()
+        .token(BOT_TOKEN)
+        .application_class(OrderedApplication)
+        .concurrent_updates(4096)  # effective limit is UPDATE_CONCURRENCY, see OrderedApplication
+        .request(InstrumentedRequest(connection_pool_size=256))
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+    )
+    if TELEGRAM_API_URL:
+        builder = builder.base_url(TELEGRAM_API_URL.rstrip("/") + "/bot")
+    persistence = build_persistence()
+    if persistence:
+        builder = builder.persistence(persistence)
+    if BOT_MODE == "webhook":
+        builder = builder.updater(None)  # updates arrive through WebhookServer
+    app = builder.build()
 
     conv_handler = ConversationHandler(
         entry_points=[
             CommandHandler("Start", start),
-            CallbackQueryHandler(confirm_delete, pattern=r"^pass\|"),
-            CallbackQueryHandler(partial_payment_cb, pattern=r"^partial\|"),
-            CallbackQueryHandler(full_payment_cb, pattern=r"^fullpay\|"),
+            CallbackQueryHandler(confirm_delete, pattern=r"^pass[:|]"),
+            CallbackQueryHandler(partial_payment_cb, pattern=r"^partial[:|]"),
+            CallbackQueryHandler(full_payment_cb, pattern=r"^fullpay[:|]"),
         ],
         states={
             ASK_NICK: [MessageHandler(filters.TEXT & ~filters.COMMAND, ask_nick)],
@@ -1328,35 +3681,185 @@ def main():
         },
         fallbacks=[],
         per_message=False,
-        allow_reentry=True
+        allow_reentry=True,
+        name="main_conversation",
+        persistent=app.persistence is not None
     )
 
     # Add handlers
     app.add_handler(conv_handler)
-    app.add_handler(CallbackQueryHandler(history_cb, pattern=r"^history\|"))
-    app.add_handler(CallbackQueryHandler(delete_cb, pattern=r"^deln\|"))
+    app.add_handler(CallbackQueryHandler(history_cb, pattern=r"^history[:|]"))
+    app.add_handler(CallbackQueryHandler(delete_cb, pattern=r"^deln[:|]"))
+    app.add_handler(CallbackQueryHandler(history_page_cb, pattern=r"^hpage[:|]"))
     app.add_handler(CommandHandler("History", history_cmd))
     app.add_handler(CommandHandler("Deletehistory", delete_history_cmd))
     app.add_handler(CommandHandler("Duecheck", duecheck_cmd))
     app.add_handler(CommandHandler("Ownerid", ownerid_cmd))
+    app.add_handler(CommandHandler("Metrics", metrics_cmd))
+    app.add_handler(CommandHandler("Reconcile", reconcile_cmd))
+    app.add_handler(CommandHandler("Export", export_cmd))
+    app.add_handler(InlineQueryHandler(inline_query_cb))
     
     # Admin management commands with regex pattern
     app.add_handler(MessageHandler(filters.Regex(r'^/Addid-\d+'), addid_cmd))
     app.add_handler(MessageHandler(filters.Regex(r'^/Removeid-\d+'), removeid_cmd))
     
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, catch_wrong_msg))
+    instrument_handlers(app)
 
     # Schedule daily tasks
-    schedule_daily_tasks(app)
+    if run_scheduler:
+        schedule_daily_tasks(app)
+
+    return app
+
+# ---- Webhook Server ----
+class WebhookServer:
+    """Minimal ASGI app for webhook mode; run it with gunicorn + uvicorn workers.
+
+    Telegram POSTs updates to WEBHOOK_PATH; the secret token header is checked
+    and the update is handed to the Application's update queue. GET /healthz
+    is for the load balancer and GET METRICS_PATH for Prometheus. Run a single
+    worker: conversation state and per-user ordering live in the process.
+    """
+
+    MAX_BODY = 1024 * 1024
+
+    def __init__(self):
+        self.application = None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+        elif scope["type"] == "http":
+            await self._http(scope, receive, send)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                try:
+                    await self.startup()
+                except Exception as e:
+                    await send({"type": "lifespan.startup.failed", "message": str(e)})
+                    return
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await self.shutdown()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def startup(self):
+        if not WEBHOOK_SECRET:
+            raise RuntimeError("WEBHOOK_SECRET is required in webhook mode")
+        app = build_application()
+        await app.initialize()
+        if app.post_init:
+            await app.post_init(app)
+        await app.start()
+        if WEBHOOK_URL:
+            await app.bot.set_webhook(
+                url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=Update.ALL_TYPES,
+            )
+        self.application = app
+        print(f"🚀 Webhook mode: listening for updates on {WEBHOOK_PATH}")
+
+    async def shutdown(self):
+        app = self.application
+        if app is None:
+            return
+        self.application = None
+        if app.running:
+            await app.stop()
+        if app.post_stop:
+            await app.post_stop(app)
+        await app.shutdown()
+        if app.post_shutdown:
+            await app.post_shutdown(app)
+
+    async def _http(self, scope, receive, send):
+        method, path = scope["method"], scope["path"]
+        if method == "GET" and path == "/healthz":
+            status = 200 if self.application and self.application.running else 503
+            await self._respond(send, status, {"ok": status == 200})
+            return
+        if method == "GET" and path == METRICS_PATH:
+            await self._respond_body(send, 200, metrics.render().encode(), PROMETHEUS_CONTENT_TYPE)
+            return
+        if path != WEBHOOK_PATH:
+            await self._respond(send, 404, {"ok": False})
+            return
+        if method != "POST":
+            await self._respond(send, 405, {"ok": False})
+            return
+
+        headers = dict(scope.get("headers") or [])
+        token = headers.get(b"x-telegram-bot-api-secret-token", b"")
+        if not WEBHOOK_SECRET or not hmac.compare_digest(token, WEBHOOK_SECRET.encode()):
+            await self._respond(send, 403, {"ok": False})
+            return
+        if self.application is None:
+            await self._respond(send, 503, {"ok": False})
+            return
+
+        body = b""
+        more = True
+        while more:
+            message = await receive()
+            body += message.get("body", b"")
+            more = message.get("more_body", False)
+            if len(body) > self.MAX_BODY:
+                await self._respond(send, 413, {"ok": False})
+                return
+
+        try:
+            update = Update.de_json(json.loads(body), self.application.bot)
+        except Exception as e:
+            print(f"⚠ Webhook payload error: {e}")
+            await self._respond(send, 400, {"ok": False})
+            return
+        if update:
+            self.application.bot.insert_callback_data(update)
+            await self.application.update_queue.put(update)
+        await self._respond(send, 200, {"ok": True})
+
+    @classmethod
+    async def _respond(cls, send, status: int, payload: dict):
+        await cls._respond_body(send, status, json.dumps(payload).encode(), "application/json")
+
+    @staticmethod
+    async def _respond_body(send, status: int, body: bytes, content_type: str):
+        await send({
+            "type": "http.response.start",
+            "status": status,
+            "headers": [(b"content-type", content_type.encode()), (b"content-length", str(len(body)).encode())],
+        })
+        await send({"type": "http.response.body", "body": body})
+
+asgi_app = WebhookServer()
+
+# ---- Main Function ----
+def main():
+    if BOT_MODE == "webhook":
+        if not WEBHOOK_SECRET:
+            raise SystemExit("❌ WEBHOOK_SECRET set karein (webhook mode mein zaroori hai)")
+        import uvicorn
+        uvicorn.run(asgi_app, host="0.0.0.0", port=PORT)
+        return
+
+    app = build_application()
 
     print("🚀 Enhanced Bot is running with:")
     print("   📊 Super Admin System")
     print("   🔔 Activity Logging & Notifications") 
-    print("   ⏰ Daily Expiry Notifications (9 AM)")
+    print(f"   ⏰ Expiry Reminders ({EXPIRY_REMINDER_DAYS} days before, {EXPIRY_NOTIFY_HOUR}:00)")
     print("   💰 Daily Due Payment Notifications (3 PM)")
     print("   🛡 Permission-based Access Control")
     print("   💳 Partial Payment System")
     print("   🎯 Duecheck Command")
+    print("   📤 CSV Export")
     print("   👥 Admin Management System")
     print("   🚫 Restricted Access System")
     print("   🧹 Auto-clear Chat (1 hour inactivity)")
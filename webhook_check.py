@@ -0,0 +1,191 @@
+"""Local check of the webhook path with a fake Telegram on both sides.
+
+Starts a fake Bot API server, points the bot at it with TELEGRAM_API_URL and
+serves bot.asgi_app with uvicorn. It then posts updates the way Telegram does
+and checks the status codes, the secret token handling and that the bot
+answers through the Bot API.
+
+    python webhook_check.py
+
+Mongo is optional: without MONGO_URI the bot runs with DB features off and
+the check talks to it as the super admin.
+"""
+import os
+
+SECRET = "webhook-check-secret"
+os.environ.update({
+    "BOT_MODE": "webhook",
+    "BOT_TOKEN": "123456:webhook-check",
+    "WEBHOOK_URL": "https://bot.example.com",
+    "WEBHOOK_SECRET": SECRET,
+    "PERSISTENCE": "none",
+    "RUN_SCHEDULER": "0",
+    "DB_STARTUP_WAIT": "0",
+})
+
+import asyncio
+import itertools
+import json
+import socket
+import sys
+from urllib.parse import parse_qs
+
+import httpx
+import uvicorn
+
+_message_ids = itertools.count(1)
+
+# ---- Fake Bot API ----
+class FakeBotApi:
+    """Answers Bot API calls with canned results and records them"""
+
+    def __init__(self):
+        self.calls = []  # (method, params)
+        self.server = None
+        self.port = 0
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._handle, "127.0.0.1", 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    def result(self, method: str, params: dict):
+        if method == "getMe":
+            return {"id": 123456, "is_bot": True, "first_name": "Check", "username": "check_bot"}
+        if method == "sendMessage":
+            return {
+                "message_id": next(_message_ids),
+                "date": 0,
+                "chat": {"id": int(params.get("chat_id", 0)), "type": "private"},
+                "text": params.get("text", ""),
+            }
+        return True
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                head = await reader.readuntil(b"\r\n\r\n")
+                lines = head.decode("latin-1").split("\r\n")
+                path = lines[0].split(" ")[1]
+                headers = {}
+                for line in lines[1:]:
+                    key, _, value = line.partition(":")
+                    headers[key.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", "0")))
+                if "json" in headers.get("content-type", ""):
+                    params = json.loads(body or b"{}")
+                else:
+                    params = {k: v[0] for k, v in parse_qs(body.decode()).items()}
+                method = path.rsplit("/", 1)[-1]
+                self.calls.append((method, params))
+                payload = json.dumps({"ok": True, "result": self.result(method, params)}).encode()
+                writer.write(
+                    b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n"
+                    + f"Content-Length: {len(payload)}\r\n\r\n".encode() + payload
+                )
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    def sent_to(self, chat_id: int) -> list[str]:
+        return [p.get("text", "") for m, p in self.calls if m == "sendMessage" and int(p.get("chat_id", 0)) == chat_id]
+
+# ---- Fake Telegram client ----
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def message_update(update_id: int, user_id: int, text: str) -> dict:
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": 0,
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "Check"},
+            "text": text,
+            "entities": [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}],
+        },
+    }
+
+async def wait_for(predicate, timeout: float = 10) -> bool:
+    deadline = asyncio.get_running_loop().time() + timeout
+    while asyncio.get_running_loop().time() < deadline:
+        if predicate():
+            return True
+        await asyncio.sleep(0.05)
+    return predicate()
+
+async def run_checks() -> list[tuple[str, bool]]:
+    api = FakeBotApi()
+    await api.start()
+    os.environ["TELEGRAM_API_URL"] = f"http://127.0.0.1:{api.port}"
+    import bot  # reads the environment above
+
+    port = free_port()
+    server = uvicorn.Server(uvicorn.Config(bot.asgi_app, host="127.0.0.1", port=port, lifespan="on", log_level="warning"))
+    serving = asyncio.create_task(server.serve())
+    results = []
+    try:
+        await wait_for(lambda: server.started or serving.done(), timeout=30)
+        methods = [m for m, _ in api.calls]
+        results.append(("startup calls getMe", "getMe" in methods))
+        webhook = [p for m, p in api.calls if m == "setWebhook"]
+        results.append(("setWebhook sends the secret", bool(webhook) and webhook[0].get("secret_token") == SECRET))
+
+        base = f"http://127.0.0.1:{port}"
+        path = base + bot.WEBHOOK_PATH
+        admin = bot.SUPER_ADMIN_ID
+        async with httpx.AsyncClient() as client:
+            r = await client.get(base + "/healthz")
+            results.append(("GET /healthz is 200", r.status_code == 200))
+
+            r = await client.post(path, json=message_update(1, admin, "/Start"))
+            results.append(("POST without secret is 403", r.status_code == 403))
+
+            headers = {"X-Telegram-Bot-Api-Secret-Token": "wrong"}
+            r = await client.post(path, json=message_update(2, admin, "/Start"), headers=headers)
+            results.append(("POST with wrong secret is 403", r.status_code == 403))
+
+            headers = [(b"X-Telegram-Bot-Api-Secret-Token", "ग़लत".encode())]
+            r = await client.post(path, json=message_update(4, admin, "/Start"), headers=headers)
+            results.append(("POST with non-ASCII secret is 403", r.status_code == 403))
+
+            headers = [(b"X-Telegram-Bot-Api-Secret-Token", b"\xff\xfe")]
+            r = await client.post(path, json=message_update(5, admin, "/Start"), headers=headers)
+            results.append(("POST with invalid UTF-8 secret is 403", r.status_code == 403))
+            await asyncio.sleep(0.5)
+            results.append(("rejected updates are not handled", not api.sent_to(admin)))
+
+            headers = {"X-Telegram-Bot-Api-Secret-Token": SECRET}
+            r = await client.post(path, json=message_update(3, admin, "/Start"), headers=headers)
+            results.append(("POST with secret is 200", r.status_code == 200))
+            results.append(("bot replies via sendMessage", await wait_for(lambda: bool(api.sent_to(admin)))))
+
+            r = await client.post(path, content=b"{not json", headers=headers)
+            results.append(("malformed update is 400", r.status_code == 400))
+
+            r = await client.get(path)
+            results.append(("GET on webhook path is 405", r.status_code == 405))
+    finally:
+        server.should_exit = True
+        await serving
+        await api.close()
+    return results
+
+def main():
+    results = asyncio.run(run_checks())
+    for name, ok in results:
+        print(f"{'PASS' if ok else 'FAIL'}  {name}")
+    failed = sum(1 for _, ok in results if not ok)
+    print(f"\n{len(results) - failed}/{len(results)} checks passed")
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()